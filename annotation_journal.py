@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+# Append-only journal of an annotation session, so that each tag given to a window
+# is kept on disk as soon as it is given (instead of rewriting the whole json file),
+# and a session that was not saved (e.g. the program crashed) can be recovered.
+#
+# The journal is a json lines file. Its first record holds the annotation data of
+# the session (the same dictionary that is saved into the json file, with no tags),
+# and the following ones the tags given to the windows and the json files where the
+# annotation was saved, in the order they happened:
+#
+#   {"session": {...annotation data...}}
+#   {"tag": ["Human", 12, {"Activity": "walking"}]}
+#   {"saved": "/home/user/session_01.json"}
+#
+# The annotation data is rebuilt by replaying the records (see replayJournal) and
+# it is written into the json file by compactJournal.
+
+import os
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class AnnotationJournal(object):
+    """Writes the journal of an annotation session.
+        path    :   the journal file.
+        data    :   the annotation data of the session. A new journal is started with it,
+                    unless it is None, in that case the records are appended to the
+                    existing journal (e.g. for continuing a recovered session).
+    """
+
+    def __init__(self, path, data=None):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        if data is None:
+            self.dropIncompleteRecord()
+            self.journal_file = open(path, 'a')
+        else:
+            self.journal_file = open(path, 'w')
+            self.append({"session": data})
+
+    def dropIncompleteRecord(self):
+        """Truncates the incomplete record the journal may end with (when the program crashed
+        while writing it), so the appended records start on their own line."""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb+') as journal_file:
+            content = journal_file.read()
+            if len(content) and not content.endswith("\n"):
+                journal_file.truncate(content.rfind("\n") + 1)
+
+    def append(self, record):
+        """Writes a record, making sure it reaches the disk before returning."""
+        self.journal_file.write(json.dumps(record) + "\n")
+        self.journal_file.flush()
+        os.fsync(self.journal_file.fileno())
+
+    def tag(self, source, window, tag_data):
+        """Records the tag (the labels of the source) given to a window."""
+        self.append({"tag": [source, window, tag_data]})
+
+    def saved(self, filename):
+        """Records that the annotation was saved into filename."""
+        self.append({"saved": filename})
+
+    def close(self):
+        self.journal_file.close()
+
+
+def replayJournal(path):
+    """Rebuilds the annotation data from a journal. Returns a tuple of the data, the
+    sorted list of the tagged windows, the json file where the annotation was last
+    saved ('' if never) and whether there are tags given after that save. Returns None
+    if the journal does not exist or it has no session."""
+    if not os.path.exists(path):
+        return None
+    data = None
+    tagged = set()
+    filename = ''
+    unsaved = False
+    with open(path) as journal_file:
+        for line in journal_file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # the last record may be incomplete if the program crashed while writing it.
+                logger.warning("Ignoring an incomplete record of the journal " + path)
+                break
+            if "session" in record:
+                data = record["session"]
+            elif data is None:
+                break
+            elif "tag" in record:
+                source, window, tag_data = record["tag"]
+                data[source]["tags"][window] = tag_data
+                tagged.add(window)
+                unsaved = True
+            elif "saved" in record:
+                filename = record["saved"]
+                unsaved = False
+    if data is None:
+        return None
+    return data, sorted(tagged), filename, unsaved
+
+
+def compactJournal(data, filename):
+    """Writes the annotation data into the json file. The file is written aside and then
+    renamed, so a crash while writing it does not destroy its previous version."""
+    partial_file = filename + ".part"
+    with open(partial_file, "w") as save_file:
+        json.dump(data, save_file, indent=4, sort_keys=True)
+    os.rename(partial_file, filename)
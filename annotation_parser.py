@@ -9,13 +9,17 @@
 # a csv that can then be used easily by other platforms.
 
 import json
-import copy
-import rosbag
 import traceback
 from PyQt5.QtGui import *
 from PyQt5.QtWidgets import *
 from PyQt5.QtCore import *
 from annotator_utils import *
+from bag_export import BagExporter
+from bag_metadata import BagMetadata
+from bag_session import BagSession, splitBagFiles, sortBagFiles, sessionName
+from file_cache import FileCache
+from topic_schema import treeLeaves
+import instrumentation
 from collections import defaultdict
 
 ### logging setup #####
@@ -24,8 +28,15 @@ handler = QtHandler()
 format = '%(asctime)s -- %(levelname)s --> %(message)s'
 date_format = '%Y-%m-%d %H:%M:%S'
 handler.setFormatter(logging.Formatter(format,date_format))
-logger.addHandler(handler)
-logger.setLevel(logging.DEBUG)
+# the verbose (DEBUG) records are only written to a rotating file. See traceFileHandler.
+trace_handler = traceFileHandler("annotation_parser")
+trace_handler.setFormatter(logging.Formatter(format,date_format))
+# the records of the modules used are logged as those of this one.
+for logger_name in (__name__, "bag_export", "bag_session", "bag_index", "instrumentation"):
+    module_logger = logging.getLogger(logger_name)
+    module_logger.addHandler(handler)
+    module_logger.addHandler(trace_handler)
+    module_logger.setLevel(logging.DEBUG)
 #######################
 
 class AnnotationParser(QWidget):
@@ -34,6 +45,7 @@ class AnnotationParser(QWidget):
 
         # the jason config data for setting labels
         self.bag = ''                       # The loaded bag object
+        self.cache = FileCache()            # keeps the index of the bags across sessions (see bag_index.py).
         self.annotationDictionary = {}      # Variable to hold the data from the annotation file.
         self.topicSelectionState = {}       # This loads the status of the topics in the tree viewer.
                                             # Used for saying which topic to save.
@@ -53,11 +65,6 @@ class AnnotationParser(QWidget):
         self.isAnnotationReady = False     # flag to say whether the json file is loaded.
         self.isBagReady = False            # flag to say whether the bag file is loaded.
         self.bag_topics = {}               # topics as extracted from the bag info.
-        self.bag_data   = {}               # a dictionary holding information loaded from the topics. it
-                                           # comprises for each topic: msg (list), time_buffer in secs (list)
-                                           # and the starting time.
-        self.csv_writers = {}              # the dictionary of csv write objects.
-        self.output_filenames = {}         # the csv file objects.
         self.mismatchTolerance = 0.02     # tolerance value for deviation in the windows slice
 
 
@@ -89,9 +96,22 @@ class AnnotationParser(QWidget):
         self.tolerance_spinbox.setToolTip("Mismatch Tolerance: Deviation from the jason and "
                                           "bag start/end endpoint")
 
+        # Create check box for the streaming (low memory) export mode
+        self.streaming_checkbox = QCheckBox("Low memory export")
+        self.streaming_checkbox.setToolTip("Reads only the selected topics and writes each window as soon "
+                                           "as it is complete, instead of loading the whole bag in memory")
+
+        # Create format dropdown list (see export_writers.py)
+        self.format_combo_box = QComboBox()
+        self.format_combo_box.addItem("CSV", "csv")
+        self.format_combo_box.addItem("NumPy columns", "npy")
+        self.format_combo_box.setToolTip("NumPy columns: a directory for each feature perspective, with a "
+                                         ".npy file for each column and a table of the rows of each window")
+
         # Create tree widget for listing the topic names
         self.tree_of_topics = QTreeWidget()
         self.tree_of_topics.setHeaderLabel("Topics")
+        self.tree_of_topics.itemExpanded.connect(self.expandTreeOfTopics)
 
         # Create a labels
         self.logOutput_label = QLabel("Log area:")
@@ -137,6 +157,7 @@ class AnnotationParser(QWidget):
         self.scroll_bar.setValue(self.scroll_bar.maximum())
 
         # Redirecting the output strem to the logOutput area.
+        self.logOutput.document().setMaximumBlockCount(LOG_MAX_LINES)
         XStream.stdout().messageWritten.connect(self.logOutput.append)
         XStream.stderr().messageWritten.connect(self.logOutput.append)
 
@@ -151,6 +172,8 @@ class AnnotationParser(QWidget):
         self.control_layout3.addWidget(self.exportButton)
         self.control_layout3.addWidget(self.mismatch_label)
         self.control_layout3.addWidget(self.tolerance_spinbox)
+        self.control_layout3.addWidget(self.streaming_checkbox)
+        self.control_layout3.addWidget(self.format_combo_box)
         self.control_layout3.setAlignment(Qt.AlignLeft)
 
         # Defining the whole main windows body layout.
@@ -172,20 +195,30 @@ class AnnotationParser(QWidget):
         self.topicSelectionONHeaders = []
 
     def generateTreeOfTopics(self, tree, dictionary):
-        """Creates the buttons of the tree of topics."""
+        """Creates the buttons of a level of the tree of topics. The buttons of the nested
+        levels are only created when their parent is expanded (see expandTreeOfTopics), with
+        the check state of their parent."""
+        # the state is read before adding the children, since the parent state follows them.
+        state = tree.checkState(0) if isinstance(tree, QTreeWidgetItem) else Qt.Unchecked
         if isinstance(dictionary, dict):
             for k, v in dictionary.iteritems():
                 if v == []:
                     child = QTreeWidgetItem(tree)
                     child.setFlags(child.flags() | Qt.ItemIsUserCheckable)
                     child.setText(0,k)
-                    child.setCheckState(0, Qt.Unchecked)
+                    child.setCheckState(0, state)
                 else:
                     parent = QTreeWidgetItem(tree)
                     parent.setText(0, k)
                     parent.setFlags(parent.flags() | Qt.ItemIsTristate | Qt.ItemIsUserCheckable)
                     parent.setFlags(parent.flags() | Qt.ItemIsTristate)
-                    self.generateTreeOfTopics(parent, v)
+                    parent.setCheckState(0, state)
+                    parent.setChildIndicatorPolicy(QTreeWidgetItem.ShowIndicator)
+
+    def expandTreeOfTopics(self, item):
+        """Creates the children buttons of a tree item the first time it is expanded."""
+        if not item.childCount():
+            self.generateTreeOfTopics(item, treeItemValue(self.annotationDictionary["topics"], item))
 
     def parseTreeOfTopics(self, subroot, dictionary):
         """Recursive Method that process the tree of loaded topics,
@@ -210,6 +243,10 @@ class AnnotationParser(QWidget):
                 newDict = {}
                 #recursively call the method passing the child of the subroot as a new parent.
                 dictionary[parent.text(0)] = self.parseTreeOfTopics(parent, newDict)
+        # A nested item not expanded yet: all its attributes have its state.
+        elif subroot.childIndicatorPolicy() == QTreeWidgetItem.ShowIndicator:
+            value = treeItemValue(self.annotationDictionary["topics"], subroot)
+            dictionary = treeLeaves(value, "ON" if subroot.checkState(0) == QtCore.Qt.Checked else "OFF")
         # Base case, where the subroot has no children. It is a primitive item.
         else:
             #set the subroot state depending whether it is checked or not.
@@ -252,10 +289,10 @@ class AnnotationParser(QWidget):
                 # defines a list of topics that are set as ON.
                 self.topicSelectionONHeaders.append(k)
 
-        logger.info("Tree selection: \n" + json.dumps(self.topicSelectionState, indent=4, sort_keys=True))
-        logger.info("Selected (ON): "+ json.dumps(self.topicSelectionON,
+        logger.debug("Tree selection: \n" + json.dumps(self.topicSelectionState, indent=4, sort_keys=True))
+        logger.debug("Selected (ON): "+ json.dumps(self.topicSelectionON,
                                                    indent=4, sort_keys=True))
-        logger.info("Selected (ON) Headers: " + json.dumps(self.topicSelectionONHeaders,
+        logger.debug("Selected (ON) Headers: " + json.dumps(self.topicSelectionONHeaders,
                                                     indent=4, sort_keys=True))
 
     def treeHasItemSelected(self):
@@ -327,25 +364,26 @@ class AnnotationParser(QWidget):
         total_win_time = self.annotationDictionary["windows_interval"]                                      \
                                                   [len(self.annotationDictionary["windows_interval"])-1]    \
                                                   [1]
-        str_buffer.append("TOTAL BAG DURATION: "+ str(total_bag_time))
-        str_buffer.append("TOTAL WINDOWING TIME: "+str(total_win_time))
-        str_buffer.append("TIME NOT USED: " + str(float((total_bag_time)-float(total_win_time))))
-        logger.info("\n".join(str_buffer))
+        logger.debug("\n".join(str_buffer))
+        logger.info("TOTAL BAG DURATION: "+ str(total_bag_time) + "\tTOTAL WINDOWING TIME: " + str(total_win_time) +
+                    "\tTIME NOT USED: " + str(float((total_bag_time)-float(total_win_time))))
 
     def openBagFile(self):
-        """Prompts the user for choosing the bag file and loads the data."""
-        self.bagFileName, _ = QFileDialog.getOpenFileName(self, "Open Bag", QDir.currentPath(), "*.bag")
+        """Prompts the user for choosing the bag file (or the chunks of a split bag) and loads the data."""
+        bagFileNames, _ = QFileDialog.getOpenFileNames(self, "Open Bag", QDir.currentPath(), "*.bag")
+        # a chunk of a split bag (see "rosbag record --split") opens all the chunks.
+        if len(bagFileNames) == 1:
+            bagFileNames = splitBagFiles(bagFileNames[0])
+        self.bagFileName = sortBagFiles(bagFileNames)[0] if len(bagFileNames) else ''
 
         # in case the bagFileName returned by the windows is not empty. That is, the
         # user did not canceled the opening of the file (situation where we get an empty name)
         if self.bagFileName != '':
             try:
                 #Read the bag.
-                self.bag = rosbag.Bag(self.bagFileName)
-                #Load the bag info into a dictionary.
-                info_dict = yaml.load(self.bag._get_yaml_info())
-                # store the topics.
-                self.bag_topics = info_dict['topics']
+                self.bag = BagSession(bagFileNames, self.cache)
+                # store the topics, read from the bag index (see bag_metadata.py).
+                self.bag_topics = BagMetadata(self.bag).topics
 
                 ### PRINT BAG INFO ###
                 string_buffer = []
@@ -353,7 +391,7 @@ class AnnotationParser(QWidget):
                 # TODO: try catch the case where there's no topics, currently a potential fatal error.
                 for top in self.bag_topics:
                     string_buffer.append("\t- " + top["topic"] + "\n\t\t-Type: " +
-                                         top["type"] + "\n\t\t-Fps: " + str(top["frequency"]))
+                                         top["type"] + "\n\t\t-Msgs: " + str(top["messages"]))
                 logger.info("\n".join(string_buffer))
                 #######
 
@@ -375,7 +413,6 @@ class AnnotationParser(QWidget):
                                  "Reason: bag is incompatible with the given annotation file.")
                     self.bagFileName = ''
                     self.bag = ''
-                    self.bag_data = ''
                     self.bag_topics = ''
             # If we don't need to check compatibility (the bag is the only file loaded),
             # confirm the bag by setting the bagFlags using the _setBagFlags.
@@ -407,39 +444,6 @@ class AnnotationParser(QWidget):
                 return False
         return True
 
-    def loadBagData(self):
-        """Sets the bag_data dictionary with with the content of the
-        loaded bag.
-            self.bag_data[topicName]["msg"] : list of msgs in the bag for the
-                                              the given topic (topicName).
-            self.bag_data[topiName]["s_time"] : time of the first msg in the
-                                                bag for the given topic
-            self.bag_data[topicName]["time_buffer_secs"] : list of msg arrival times (in secs)
-                                                            for the given bag.
-        """
-        self.bag_data = {}
-
-        for t_name in [top["topic"] for top in self.bag_topics]:
-            # define msg structure. See method stringdoc.
-            self.bag_data[t_name] = {}
-            self.bag_data[t_name]["msg"] = []
-            self.bag_data[t_name]["s_time"] = None
-            self.bag_data[t_name]["time_buffer_secs"] = []
-
-        # Buffer the images, timestamps from the rosbag
-        for topic, msg, t in self.bag.read_messages(topics=[top["topic"] for top in self.bag_topics]):
-            try:
-                if self.bag_data[topic]["s_time"] == None:
-                    self.bag_data[topic]["s_time"] = t      # sets initial time for the topic s_time.
-
-
-                self.bag_data[topic]["msg"].append(msg)             # append msg
-                # append second difference between the current time ant the s_time.
-                self.bag_data[topic]["time_buffer_secs"].append(t.to_sec() -
-                                                                 self.bag_data[topic]["s_time"].to_sec())
-            except:
-                logger.debug("Error: " + topic)
-
     def loadJson(self, filename):
         """Loads a json. Returns its content in a dictionary"""
         with open(filename) as json_file:
@@ -468,145 +472,6 @@ class AnnotationParser(QWidget):
         msgBox.resize(100,40)
         msgBox.exec_()
 
-    def writeData(self):
-        """This function loops through the self.bag_data["msg] data list and based on
-        the windows division (self.windowsInterval), prints the data the csv file."""
-
-        logger.info("Aligning different time buffers...")
-        # getting a combined timeline using the topics timebuffers.
-        self.timeline = {}              # combined time line
-        self.sorted_timeline = {}       # the sorted combined time line (it is necessary since dicts are unsorted)
-        for s_name in self.annotationDictionary["sources"]:
-            combined_buffer = {}
-            for topicName in self.topicSelectionON.keys():
-                # getting a combined timeline for all user selected topics. combined buffer
-                # is a dictionary structure that saves the time(in secs) as key and each topic
-                # in the given time as values. If two different topics have the same time, they
-                # are stored as a list.
-                [combined_buffer.setdefault(t,[]).append(topicName)
-                 for t in self.bag_data[topicName]["time_buffer_secs"]]
-
-            # saving the current combined buffer for the feature category (tabs)
-            self.timeline[s_name] = combined_buffer
-            # sorting the combined buffer for easing the following loops.
-            self.sorted_timeline[s_name] = sorted(combined_buffer)
-
-            try:
-                assert len(self.sorted_timeline[s_name]) == len(set(self.timeline[s_name].keys()))
-            except:
-                logger.error(traceback.format_exc())
-
-        try:
-            # For each feature category (tabs)
-            for s_name in self.annotationDictionary["sources"]:
-                # Loops through all windows.
-                for t,w in enumerate(self.windowsInterval):
-                    logger.info("Feature Category: "+ s_name + '\tWin#: ' + str(t))
-                    # skip empty tag in the jason file.
-                    if self.annotationDictionary[s_name]["tags"][t] == []:
-                        # print empty row to the output csv file
-                        self.csv_writers[s_name].writerows([{}])
-                    else:
-                        start = w[0]        # start of the windows
-                        end = w[1]          # end of the windows
-                        buffer = []         # windows content
-                        index_s = 0         # windows start index (allowing looping through the self.timeline)
-                        index_e = 0         # windows end index (allowing looping through the self.timeline)
-
-                        ##### loops to discover start index
-                        for i in range(len(self.sorted_timeline[s_name])):
-                            if self.sorted_timeline[s_name][i] >= start:
-                                index_s = i     # set windows start index.
-                                break           # exit this start index discovering loop.
-
-                        ##### loops, getting the msg data until the windows end endpoint is reached
-                        for j in range(index_s,len(self.sorted_timeline[s_name])):
-                            # loops while the current index is less then or equal to the windows end endpoint
-                            if self.sorted_timeline[s_name][j] <= end:
-                                index_e = j     # sets the current index for the data.
-                                # copy tag data from current window
-                                row = copy.copy(self.annotationDictionary[s_name]["tags"][t])
-                                # set the current time stamp for the row
-                                row["time"] = self.sorted_timeline[s_name][index_e]
-                                # calls self._getMsgValue to retrieve the data for each selected topic (topic field).
-                                for topicName in self.timeline[s_name][row["time"]]:
-                                    # get data. NOTE: the msg vector is aligned with the time_buffer_sec
-                                    # for a given topic, this is because they are currently being saved at
-                                    # the same time in getBagData() method. So, we only have to discover
-                                    # which msg index is associated with the self.sorted_timeline[s_name]
-                                    # value at index_e.
-                                    row = self.getTopicValue(row, self.bag_data[topicName]["msg"]
-                                    [self.bag_data[topicName]["time_buffer_secs"].index(row["time"])], topicName)
-                                    # append row to the windows row batch
-                                    buffer.append(row)
-                            else:
-                                break       ### spin the windows, allowing to move on.
-
-                        ##### Checks whether the deviation between the windows "begin"
-                        ##### and "end" times is less the tolerance value.
-                        try:
-                            assert abs(start - self.sorted_timeline[s_name][index_s]) < self.mismatchTolerance
-                            logger.info("WStart: " + str(start) + " Retrieval start:" +
-                                        str(self.sorted_timeline[s_name][index_s]) + " Sync: OK!")
-                        except Exception as e:
-                            logger.error("Beginning of the windows is out of sync! MustBe: "+
-                                         str(start) + "\tWas: " + str(self.sorted_timeline[s_name][index_s]))
-                        try:
-                            assert abs(end -self.sorted_timeline[s_name][index_e]) < self.mismatchTolerance
-                            logger.info("WEnd: " + str(end) + " Retrieval end:" +
-                                        str(self.sorted_timeline[s_name][index_e]) + " Sync: OK!")
-                        except Exception as e:
-                            logger.error("End of the windows is out of sync! MustBe: "+
-                                         str(end) + "\tWas: " +
-                                         str(self.sorted_timeline[s_name][index_e]))
-
-                        ##### Prints the windows content (row batch) to the corresponding (s_name) csv file.
-                        self.csv_writers[s_name].writerows(buffer)  #write content to the file
-                        self.csv_writers[s_name].writerows([{}])    #write an empty line to mark the end of the windows
-                        self.output_filenames[s_name].flush()       #flush data.
-
-        except:
-            logger.error(traceback.format_exc())
-
-    def getTopicValue(self, dictionary, msg, parent, ignore = ["header"]):
-        """Recursively saves in "dictionary" the msg values of the topics set on in the
-        tree.
-            dictionary : a dictionary returned by the function where the key is the name of
-                         the topic, followed by its attribute names (all the way down to the
-                         primitive one) and the value is the rosbag topic field msg value.
-            msg:        the rosbag msg from which to extract the values.
-            parent  :   the topic name from which to search the value in the rosbag msg. note
-                        that it is common to have nested data types and so, the parent name is
-                        used in order to describe the level of the data topic structure the re-
-                        cursion is at. For example, a 6-DOF accelerometer data type may have
-                        different attributes, like "gyro" and "acc" each of which may have other
-                        attributes like "x","y","z".
-            ignore  :   the list of ignored attributes in the msg.
-        """
-        # if the current topic level has attributes (i.e., it is not a primitive time)
-        if hasattr(type(msg), '__slots__'):
-            # loops through each attribute of this type
-            for s in type(msg).__slots__:
-                # ignores attribute if it is in the ignore list.
-                if s in ignore:
-                    continue
-                else:
-                    # get the attribute msg value.
-                    val = msg.__getattribute__(s)
-                    # call the current method again to check if the val attribute value
-                    # has another attribute members.
-                    dictionary = self.getTopicValue(dictionary, val, ".".join([parent, s]))
-        else:
-            # if the msg is of a primitive type, set it to dictionary, but only if
-            # it is one of the selected topics by the user.
-            if parent in self.topicSelectionONHeaders:
-                dictionary[parent] = msg
-
-        # NOTE: that if the parent (data) does not belong to the selected topics by the
-        # user, the dictionary returned in the current recursion call is the same of the
-        # previous one.
-        return dictionary
-
     def exportCSV(self):
         """Opens a dialog windows and asks the general filename
         used for saving the data. It generates as much files as those
@@ -618,51 +483,34 @@ class AnnotationParser(QWidget):
         # checks whether the user has loaded the bag and the jason file and
         # has also checked at least one topic from the tree of topics.
         if self.isExportEnable() and self.treeHasItemSelected():
-            # loads the bag file data in the self.bag_data dictionary variable.
-            self.loadBagData()
             # defaults directory to the one where the parser program is located in
             defaultdir = os.path.dirname(os.path.abspath(__file__))
             # defaults the name of the output file(s) to the name of the bag + "csv".
-            defaultname = self.bagFileName.split("/")[-1][:-4] + ".csv"
+            defaultname = sessionName(self.bag.filenames) + ".csv"
             # gets the name of the file from windows.
             insertedName = QFileDialog.getSaveFileName(self, 'Save File', defaultdir + "/"
                                                        + defaultname, filter='*.csv')
             # does nothing in case the file name is empty (the user closed the save windows
             # before pressing save button on it)
             if insertedName[0] != '':
-                ###### Process the filename
-                # removing .csv extension. This is done because we append to the file
-                # the name of the feature perpective (tab name in the annotator.py)
-                if insertedName[0].endswith(".csv"):
-                    filename = insertedName[0][:-4]     #remove .csv
-                else:
-                    # keep the name as it is in case it has no csv extension
-                    filename = insertedName[0]
-
+                # the exporter appends to the file name the name of the feature perspective
+                # (tab name in the annotator.py), generating a csv file for each one of them.
+                exporter = BagExporter(self.bag, self.annotationDictionary,
+                                       self.topicSelectionONHeaders, self.mismatchTolerance)
+                # the timings of the stages of this export (see instrumentation.py).
+                instrumentation.reset()
                 try:
-                    #variable that holds the outputfiles for each perspective. Type: dictionary.
-                    self.output_filenames = {}
-                    #loop through perspectives.
-                    for s_name in self.annotationDictionary["sources"]:
-                        # append to the filename the feature perspective name
-                        filename = filename + "_" + s_name + ".csv"
+                    # In the streaming mode the data is read while writing the windows. Otherwise,
+                    # the bag data is loaded before in the exporter.bag_data dictionary variable.
+                    for filename in exporter.export(insertedName[0], self.streaming_checkbox.isChecked(),
+                                                    self.format_combo_box.currentData()):
                         # set the "Exported to" text area
                         self.exportTextArea.append("\n" + filename)
-                        # set output files
-                        self.output_filenames[s_name] = open(filename, 'wa')
-                        # define the headers for the csv files (variable, column, names).
-                        self.csv_writers[s_name] = csv.DictWriter(self.output_filenames[s_name],
-                                                                  ["time"] + self.annotationDictionary[s_name]["labels"]
-                                                                  + self.topicSelectionONHeaders)
-                        # write the headers
-                        self.csv_writers[s_name].writeheader()
-                        # flush data
-                        self.output_filenames[s_name].flush()
                 except Exception as e:
                     logger.error(traceback.format_exc())
-
-                # loop through the data printing the windows content.
-                self.writeData()
+                instrumentation.report("export of " + str(exporter.msg_count) + " msgs, " +
+                                       str(exporter.row_count) + " rows")
+                instrumentation.dump(LOG_DIR, "annotation_parser")
 
         # If there is no topic selected in the tree of topics before the button is pressed, ask the user
         # to select at least one.
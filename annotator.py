@@ -1,15 +1,14 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-"""The Video Widget example shows how to implement a video widget
-using QtMultimedia's QAbstractVideoSurface.
-
-The following is a translation into PyQt5 from the C++ example found in
-C:\QtEnterprise\5.1.1\msvc2010\examples\multimediawidgets\customvideosurface\customvideowidget."""
+"""The annotator shows the frames of an image topic of a bag, window by window, for
+tagging the data of the other topics. The frames are decoded from the bag (see
+frame_source.py) and painted by the VideoWidget, with no intermediate video file
+nor media player."""
 from __future__ import division
-import rosbag
 
 import json
+import traceback
 import matplotlib
 
 matplotlib.use("Qt5Agg")
@@ -18,8 +17,13 @@ from cv_bridge import CvBridge, CvBridgeError
 from PyQt5.QtGui import *
 from PyQt5.QtWidgets import *
 from PyQt5.QtCore import *
-from PyQt5.QtMultimedia import *
 from annotator_utils import *
+from frame_source import FrameSource
+from bag_session import BagSession, splitBagFiles, sessionName
+from file_cache import FileCache
+from topic_schema import SchemaRegistry
+from annotation_journal import AnnotationJournal, replayJournal, compactJournal
+import instrumentation
 
 ### logging setup #####
 logger = logging.getLogger(__name__)
@@ -27,95 +31,159 @@ handler = QtHandler()
 format = '%(asctime)s -- %(levelname)s --> %(message)s'
 date_format = '%Y-%m-%d %H:%M:%S'
 handler.setFormatter(logging.Formatter(format,date_format))
-logger.addHandler(handler)
-logger.setLevel(logging.DEBUG)
-
-class VideoWidgetSurface(QAbstractVideoSurface):
-
-    def __init__(self, widget, parent=None):
-        super(VideoWidgetSurface, self).__init__(parent)
-        self.widget = widget
-        self.imageFormat = QImage.Format_Invalid
-
-    def supportedPixelFormats(self, handleType=QAbstractVideoBuffer.NoHandle):
-        formats = [QVideoFrame.PixelFormat()]
-        if (handleType == QAbstractVideoBuffer.NoHandle):
-            for f in [QVideoFrame.Format_RGB32, QVideoFrame.Format_ARGB32, QVideoFrame.Format_ARGB32_Premultiplied, QVideoFrame.Format_RGB565, QVideoFrame.Format_RGB555,QVideoFrame.Format_BGR24,QVideoFrame.Format_RGB24]:
-                formats.append(f)
-        return formats
-
-    def isFormatSupported(self, _format):
-        imageFormat = QVideoFrame.imageFormatFromPixelFormat(_format.pixelFormat())
-        size = _format.frameSize()
-        _bool = False
-        if (imageFormat != QImage.Format_Invalid and not size.isEmpty() and _format.handleType() == QAbstractVideoBuffer.NoHandle):
-            _bool = True
-        return _bool
-
-    def start(self, _format):
-        global frameCounter
-        imageFormat = QVideoFrame.imageFormatFromPixelFormat(_format.pixelFormat())
-        size = _format.frameSize()
-        frameCounter = 0 #Frame Counter initialize
-        if (imageFormat != QImage.Format_Invalid and not size.isEmpty()):
-            self.imageFormat = imageFormat
-            self.imageSize = size
-            self.sourceRect = _format.viewport()
-            QAbstractVideoSurface.start(self, _format)
-            self.widget.updateGeometry()
-            self.updateVideoRect()
-            return True
+# the verbose (DEBUG) records are only written to a rotating file. See traceFileHandler.
+trace_handler = traceFileHandler("annotator")
+trace_handler.setFormatter(logging.Formatter(format,date_format))
+# the records of the modules used are logged as those of this one.
+for logger_name in (__name__, "frame_source", "frame_store", "file_cache", "annotation_journal",
+                    "bag_session", "bag_index", "instrumentation"):
+    module_logger = logging.getLogger(logger_name)
+    module_logger.addHandler(handler)
+    module_logger.addHandler(trace_handler)
+    module_logger.setLevel(logging.DEBUG)
+
+TIMINGS_INTERVAL_MS = 5000     # period of the timings logged with the instrumentation on.
+
+
+class Worker(QThread):
+    """Runs a function out of the GUI thread. The function receives the worker as its first
+    argument, which it uses for reporting its progress (reportProgress) and for checking
+    whether it was cancelled (isCancelled). The result of the function is sent by the done
+    signal, unless the worker was cancelled, and exceptions are sent by the failed signal."""
+    progress = pyqtSignal(int, int)
+    done = pyqtSignal(object)
+    failed = pyqtSignal(str)
+
+    def __init__(self, function, *args):
+        super(Worker, self).__init__()
+        self.function = function
+        self.args = args
+        self.cancelled = False
+        self.bag = None         # the BagSession read by the function, if any. See VideoPlayer.waitForBagWorkers.
+
+    def run(self):
+        try:
+            result = self.function(self, *self.args)
+        except Exception:
+            self.failed.emit(traceback.format_exc())
         else:
-            return False
+            if not self.cancelled:
+                self.done.emit(result)
 
-    def stop(self):
-        self.currentFrame = QVideoFrame()
-        self.targetRect = QRect()
-        QAbstractVideoSurface.stop(self)
-        self.widget.update()
-
-    def present(self, frame):
-        global frameCounter,removeBool
-        if (self.surfaceFormat().pixelFormat() != frame.pixelFormat() or self.surfaceFormat().frameSize() != frame.size()):
-            self.setError(QAbstractVideoSurface.IncorrectFormatError)
-            self.stop()
-            return False
-        else:
-            self.currentFrame = frame
-            frameCounter += 1
-            removeBool = True #Removes the boxes on current frame
-            self.widget.repaint(self.targetRect)
-            return True
+    def cancel(self):
+        self.cancelled = True
 
-    def videoRect(self):
-        return self.targetRect
+    def isCancelled(self):
+        return self.cancelled
 
-    def updateVideoRect(self):
-        size = self.surfaceFormat().sizeHint()
-        size.scale(self.widget.size().boundedTo(size), Qt.KeepAspectRatio)
-        self.targetRect = QRect(QPoint(0, 0), size);
-        self.targetRect.moveCenter(self.widget.rect().center())
-
-    def paint(self, painter):
-        if (self.currentFrame.map(QAbstractVideoBuffer.ReadOnly)):
-            oldTransform = painter.transform()
-            if (self.surfaceFormat().scanLineDirection() == QVideoSurfaceFormat.BottomToTop):
-                painter.scale(1, -1);
-                painter.translate(0, -self.widget.height())
-
-            image = QImage(self.currentFrame.bits(),
-                    self.currentFrame.width(),
-                    self.currentFrame.height(),
-                    self.currentFrame.bytesPerLine(),
-                    self.imageFormat
-            )
-
-            painter.drawImage(self.targetRect, image, self.sourceRect)
-            painter.setTransform(oldTransform)
-
-            self.currentFrame.unmap()
+    def reportProgress(self, done, total):
+        self.progress.emit(done, total)
+
+class FramePlayer(QObject):
+    """Plays the frames of a window of the image topic at the times they were recorded in
+    the bag, looping over the window. The frames are not polled: a single shot timer is
+    scheduled for the time of the next frame, measured from the time the playing started
+    (so the timer errors do not accumulate). The window is given as a range of frames (see
+    setWindow), thus the playing stops exactly at its last frame. Only the played frames
+    (see frame_source.cappedFrames) are shown while playing. The frameChanged signal gives
+    the index of the frame to be shown."""
+    frameChanged = pyqtSignal(int)
+    stateChanged = pyqtSignal(bool)
+
+    def __init__(self, parent=None):
+        super(FramePlayer, self).__init__(parent)
+        self.times_secs = np.zeros(0)   # time of each frame (in secs).
+        self.played = np.zeros(0, dtype=np.int64)   # sorted indexes of the frames shown while playing.
+        self.first = 0                  # [first, end) range of frames of the window played.
+        self.end = 0
+        self.end_secs = 0.0             # time where the window ends (the last frame is shown until then).
+        self.current = -1               # index of the frame shown.
+        self.playing = False
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setTimerType(Qt.PreciseTimer)
+        self.timer.timeout.connect(self.nextFrame)
+        self.clock = QElapsedTimer()    # measures the time since origin_secs was shown.
+        self.origin_secs = 0.0
+
+    def setFrameTimes(self, times_secs, played=None):
+        self.pause()
+        self.times_secs = times_secs
+        self.played = np.arange(len(times_secs)) if played is None else played
+        self.first = self.end = 0
+        self.current = -1
+
+    def setWindow(self, first, end, end_secs):
+        """Sets the window played: the frames in the [first, end) range, the last one being
+        shown until end_secs. The window has at least one frame."""
+        self.first = int(min(first, len(self.times_secs) - 1))
+        self.end = int(max(min(end, len(self.times_secs)), self.first + 1))
+        self.end_secs = max(end_secs, self.times_secs[self.end - 1])
+
+    def isPlaying(self):
+        return self.playing
+
+    def play(self):
+        if not self.playing and len(self.times_secs):
+            self.playing = True
+            self.stateChanged.emit(True)
+            self.seek(self.current if self.first <= self.current < self.end else self.first)
+
+    def pause(self):
+        if self.playing:
+            self.playing = False
+            self.timer.stop()
+            self.stateChanged.emit(False)
+
+    def toggle(self):
+        if self.playing:
+            self.pause()
+        else:
+            self.play()
+
+    def seek(self, i):
+        """Shows the i-th frame, playing from it if the player is playing."""
+        self.current = i
+        self.frameChanged.emit(i)
+        if self.playing:
+            self.origin_secs = self.times_secs[i]
+            self.clock.start()
+            self.scheduleNext()
+
+    def nextIndex(self, i):
+        """Returns the index of the frame played after the i-th one (the number of frames if none)."""
+        j = self.played.searchsorted(i, side='right')
+        return int(self.played[j]) if j < len(self.played) else len(self.times_secs)
+
+    def scheduleNext(self):
+        """Starts the timer for the time of the next frame (or the end of the window)."""
+        if self.nextIndex(self.current) < self.end:
+            target_secs = self.times_secs[self.nextIndex(self.current)]
+        else:
+            target_secs = self.end_secs
+        delay = (target_secs - self.origin_secs) * 1000 - self.clock.elapsed()
+        self.timer.start(max(0, int(round(delay))))
+
+    def nextFrame(self):
+        if not self.playing:
+            return
+        following = self.nextIndex(self.current)
+        if following >= self.end:
+            # the window ended, so it is played again from its beginning.
+            self.seek(self.first)
+            return
+        # the played frame due now. When showing the frames takes longer than their period,
+        # the frames already late are skipped (but never the last one of the window).
+        now_secs = self.origin_secs + self.clock.elapsed() / 1000.0
+        j = self.played.searchsorted(self.times_secs.searchsorted(now_secs, side='right') - 1, side='right') - 1
+        i = int(self.played[j]) if j >= 0 else following
+        self.current = min(max(i, following), self.end - 1)
+        self.frameChanged.emit(self.current)
+        self.scheduleNext()
 
 class VideoWidget(QWidget):
+    """Shows the frames of the image topic, scaled to the widget keeping their aspect ratio.
+    The frames are painted directly from their numpy arrays (see showImage)."""
 
     def __init__(self, parent=None):
         global classLabels, imageBuffer
@@ -128,7 +196,9 @@ class VideoWidget(QWidget):
         self.setPalette(palette)
         self.setSizePolicy(QSizePolicy.MinimumExpanding ,
         QSizePolicy.MinimumExpanding)
-        self.surface = VideoWidgetSurface(self)
+        self.frame = None               # the array of the frame shown, which the image is painted from.
+        self.image = QImage()
+        self.targetRect = QRect()
         self.vanishBox = False
         self.enableWriteBox = False
         self.annotEnabled = False
@@ -139,44 +209,47 @@ class VideoWidget(QWidget):
         classLabels = []
         imageBuffer = []
 
+    def showImage(self, frame):
+        """Shows a frame, a BGRA numpy array (see FrameSource). The frame is wrapped in a QImage
+        with no copy, so the array is kept (and must not change) while it is shown."""
+        height, width = frame.shape[:2]
+        resized = self.image.width() != width or self.image.height() != height
+        self.frame = frame
+        self.image = QImage(frame.data, width, height, frame.strides[0], QImage.Format_RGB32)
+        if resized:
+            self.updateGeometry()
+            self.updateVideoRect()
+            self.update()
+        self.repaint(self.targetRect)
 
-    def videoSurface(self):
-        return self.surface
+    def videoRect(self):
+        return self.targetRect
+
+    def updateVideoRect(self):
+        size = self.image.size()
+        size.scale(self.size().boundedTo(size), Qt.KeepAspectRatio)
+        self.targetRect = QRect(QPoint(0, 0), size)
+        self.targetRect.moveCenter(self.rect().center())
 
     def sizeHint(self):
-        return self.surface.surfaceFormat().sizeHint()
+        return self.image.size() if not self.image.isNull() else QWidget.sizeHint(self)
 
     #Shows the video
     def paintEvent(self, event):
-        global start_point
-        global end_point
-        global frameCounter
-        global timeId
-
         painter = QPainter(self)
-        rectPainter = QPainter(self)
-
-        if not rectPainter.isActive():
-            rectPainter.begin(self)
-
-        if (self.surface.isActive()):
-            videoRect = QRegion(self.surface.videoRect())
-            if not videoRect.contains(event.rect()):
-                region = event.region()
-                region.subtracted(videoRect)
-                brush = self.palette().background()
-                for rect in region.rects():
-                    painter.fillRect(rect, brush)
-            self.surface.paint(painter)
+        if not self.image.isNull():
+            # the area around the frame is filled with the background.
+            region = event.region().subtracted(QRegion(self.targetRect))
+            brush = self.palette().background()
+            for rect in region.rects():
+                painter.fillRect(rect, brush)
+            painter.drawImage(self.targetRect, self.image)
         else:
             painter.fillRect(event.rect(), self.palette().window())
 
-        if rectPainter.isActive():
-            rectPainter.end()
-
     def resizeEvent(self, event):
         QWidget.resizeEvent(self, event)
-        self.surface.updateVideoRect()
+        self.updateVideoRect()
 
 class VideoPlayer(QWidget):
     def __init__(self, parent=None):
@@ -186,14 +259,20 @@ class VideoPlayer(QWidget):
         self.metric_buffer = []
         self.filename = ''
         self.isUnsave = True
-        self.mediaPlayer = QMediaPlayer(None, QMediaPlayer.VideoSurface)
-        self.WINDOWS_MISMATCH_TOLERANCE = 0.01      #tolerance for mismatch in the windows endpoint.
-        self.current_begin_mismatch = -1
+        self.player = FramePlayer(self)             #plays the frames of the windows. See FramePlayer.
+        self.cache = FileCache()                    #keeps data computed from the bags across sessions.
+        self.journal = None                         #keeps the tags as they are given. See startJournal.
+        # with the instrumentation on, the timings of the stages are logged periodically (see instrumentation.py).
+        self.timings_timer = QTimer(self)
+        self.timings_timer.timeout.connect(lambda: instrumentation.report("annotator", changes_only=True))
+        if instrumentation.ENABLED:
+            self.timings_timer.start(TIMINGS_INTERVAL_MS)
 
         # the jason config data for setting labels
         self.label_configs = self.parseConfig()
         self.data = {}
-        self.types = {}          # This loads the type of objects in the treeviewer. Used for saying which topic to save.
+        self.schemas = SchemaRegistry(self.cache)   # trees of the msg types. See buffer_data.
+        self.bag = None          # the opened bags (see bag_session.py).
         self.isBagLoaded = False
         self.videoWidget = VideoWidget()
         self.openButton = QPushButton("Open...")
@@ -229,10 +308,19 @@ class VideoPlayer(QWidget):
         self.positionSlider.setRange(0, 0)
         self.positionSlider.sliderPressed.connect(self.setPosition)
 
+        # Shows the progress of the work done in background (e.g. bag loading)
+        self.progressBar = QProgressBar()
+        self.progressBar.setMaximumWidth(250)
+        self.progressBar.setVisible(False)
+        self.workers = []           # the background workers running. See Worker class.
+        self.cancelled_workers = [] # the cancelled workers still running. See cancelWorkers.
+        self.frame_source = None    # the frames of the image topic. See buffer_data.
+
 
         self.tree_of_topics = QTreeWidget()
         self.tree_of_topics.setHeaderLabel("Topics")
         self.tree_of_topics.setMaximumWidth(500)
+        self.tree_of_topics.itemExpanded.connect(self.expandTreeItem)
 
         ### BUTTONS FOR THE SECOND CONTROL BUTTON LAYOUT
         # Create a label widget for buttons in the second layout
@@ -285,6 +373,7 @@ class VideoPlayer(QWidget):
         self.scroll_bar = self.logOutput.verticalScrollBar()
         self.scroll_bar.setValue(self.scroll_bar.maximum())
 
+        self.logOutput.document().setMaximumBlockCount(LOG_MAX_LINES)
         XStream.stdout().messageWritten.connect(self.logOutput.append)
         XStream.stderr().messageWritten.connect(self.logOutput.append)
 
@@ -320,6 +409,7 @@ class VideoPlayer(QWidget):
         self.control_button_layout1.addWidget(self.reloadButton)
         self.control_button_layout1.addWidget(self.positionSlider)
         self.control_button_layout1.addWidget(self.duration_label)
+        self.control_button_layout1.addWidget(self.progressBar)
         self.control_button_layout2.addWidget(self.previousDWindowButton)
         self.control_button_layout2.addWidget(self.playButton)
         self.control_button_layout2.addWidget(self.nexstDWindowButton)
@@ -424,13 +514,12 @@ class VideoPlayer(QWidget):
         layout.addLayout(self.control_button_layout4)
         self.setLayout(layout)
 
-        self.mediaPlayer.setVideoOutput(self.videoWidget.videoSurface())
-        self.mediaPlayer.stateChanged.connect(self.mediaStateChanged)
-        self.mediaPlayer.positionChanged.connect(self.positionChanged)
-        self.mediaPlayer.durationChanged.connect(self.durationChanged)
-        self.mediaPlayer.setNotifyInterval(1)
+        self.player.stateChanged.connect(self.playerStateChanged)
+        self.player.frameChanged.connect(self.frameChanged)
 
     def addToTree(self, tree, dictionary):
+        """Adds a level of the dictionary of topics to the tree. The items of the nested levels
+        are only added when their parent is expanded (see expandTreeItem)."""
         if isinstance(dictionary, dict):
             for k, v in dictionary.iteritems():
                 if v == []:
@@ -443,7 +532,12 @@ class VideoPlayer(QWidget):
                     parent.setText(0, k)
                     #parent.setFlags(parent.flags() | Qt.ItemIsTristate | Qt.ItemIsUserCheckable)
                     #parent.setFlags(parent.flags() | Qt.ItemIsTristate)
-                    self.addToTree(parent, v)
+                    parent.setChildIndicatorPolicy(QTreeWidgetItem.ShowIndicator)
+
+    def expandTreeItem(self, item):
+        """Adds the children of a tree item the first time it is expanded."""
+        if not item.childCount():
+            self.addToTree(item, treeItemValue(self.data["topics"], item))
 
 
     def getTreeSelection(self,subroot, dictionary):
@@ -505,6 +599,7 @@ class VideoPlayer(QWidget):
                 reply = QMessageBox.question(self, 'Confirm Overwrite',msg, QMessageBox.Yes, QMessageBox.No)
                 if reply == QMessageBox.Yes:
                     self.data[t_name]["tags"][current_windows] = tag_data#[tag_data[l] for l in self.data[t_name]["labels"]]
+                    self.journal.tag(t_name, current_windows, tag_data)
                     logger.info("ANNOTATION FOR WINDOWS " + str(current_windows) + " <- OVERWRITTEN!")
                     self.isUnsave = True
                     if not self.filename == "":
@@ -513,6 +608,7 @@ class VideoPlayer(QWidget):
                         self.setWindowTitle('* UNTITLED '+ '-' + __file__)
             else:
                 self.data[t_name]["tags"][current_windows] = tag_data
+                self.journal.tag(t_name, current_windows, tag_data)
                 self.listOftaggedWindows.append(current_windows)
                 self.listOftaggedWindows.sort()
                 self.isUnsave = True
@@ -541,8 +637,13 @@ class VideoPlayer(QWidget):
                 self.previousDWindowButton.setEnabled(True)
                 self.nexstDWindowButton.setEnabled(True)
 
-            millis = self.windows_begin_end_times[curr][0] * 1000
-            self.updateSliderPosition(millis)
+            (first, end) = self.window_frames[curr]
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("WINDOW " + str(curr) + ": " + str(end - first) + " frames, msgs of the topics: " +
+                             str(dict((topic, int(ranges[curr][1] - ranges[curr][0]))
+                                      for topic, ranges in self.window_msgs.items())))
+            self.player.setWindow(first, end, self.windows_begin_end_times[curr][1])
+            self.player.seek(self.player.first)
 
     #Listens to the change in the overlap dropdown list
     def overlapComboxChanged(self, i):
@@ -567,6 +668,7 @@ class VideoPlayer(QWidget):
         self.data["number_windows"] = self.number_of_windows
         self.data["duration"] = self.duration
         self.data["used_image_topic"] = self.current_image_topic
+        self.data["bags"] = [os.path.basename(f) for f in self.bag.filenames]
 
     def reload(self):
         """Checks saved work before reseting."""
@@ -584,66 +686,174 @@ class VideoPlayer(QWidget):
 
     def reset(self):
         """Unconditionally reset the environment"""
+        self.cancelWorkers()
+        self.player.pause()
         self.windows_combo_box.clear()
         self.topics_to_save = {}
-        self.types = {}
         self.isUnsave = True
         self.tree_of_topics.clear()
         self.listOftaggedWindows = []
         self.loadImageTopic(self.topics_combo_box.currentText())
 
-    def openFile(self):
-        global imageBuffer,framerate
-        self.bagfileName,_ = QFileDialog.getOpenFileName(self, "Open Bag", QDir.currentPath(),"*.bag")
-        if self.bagfileName != '':
-            if not self.bagfileName:
-                pass
+    def startWorker(self, function, done, *args, **options):
+        """Runs function(worker, *args) in background (see Worker class), calling done
+        with its result when it finishes. The bag option is the BagSession the function
+        reads, if any (see waitForBagWorkers)."""
+        worker = Worker(function, *args)
+        worker.bag = options.get("bag")
+        worker.done.connect(done)
+        worker.failed.connect(self.workerFailed)
+        worker.progress.connect(self.workerProgress)
+        worker.finished.connect(self.workerFinished)
+        self.workers.append(worker)
+        worker.start()
+        return worker
+
+    def cancelWorkers(self, wait=False):
+        """Cancels the background workers. Their signals are disconnected, so their results are
+        dropped, and they stop at their next isCancelled check. They are kept (see workerFinished)
+        until their threads finish, unless wait is set (e.g. when the program exits), which blocks
+        until then. See waitForBagWorkers for those reading the bag."""
+        for worker in self.workers:
+            worker.cancel()
+            worker.done.disconnect()
+            worker.failed.disconnect()
+            worker.progress.disconnect()
+            if wait:
+                worker.wait()
             else:
-                try:
-                    self.bag = rosbag.Bag(self.bagfileName)
-                except:
-                    self.errorMessages(0)
-
-                #Get bag metadata
-                (self.message_count,self.duration, self.topics,
-                 self.compressedImageTopics,compressed, framerate) = get_bag_metadata(self.bag)
-                #Buffer the rosbag, boxes, timestamps
-
-                logger.info("TOPICS FOUND:") #TODO: try catch the case where theres no topics. Potential fatal error.
-                for top in self.topics:
-                    logger.info("\t- " + top["topic"] + "\n\t\t-Type: "+
-                                                       top["type"]+"\n\t\t-Fps: "+ str(top["frequency"]))
-                logger.info("BAG TOTAL DURATION: " + str(self.duration))
-                if len(self.compressedImageTopics):
-                    self.topics_combo_box.addItems(self.compressedImageTopics)
-                    self.reloadButton.setEnabled(True)
-                else:
-                    self.errorMessages(6)
-                self.isBagLoaded = True
-            self.reset()
+                self.cancelled_workers.append(worker)
+        self.workers = []
+        self.progressBar.setVisible(False)
+
+    def waitForBagWorkers(self, bag):
+        """Waits until the cancelled workers reading the bag finish (they stop at their next
+        isCancelled check). A BagSession is not thread safe, so it cannot be read by another
+        worker nor closed until then. The cancelled workers not reading it are not waited for."""
+        for worker in self.cancelled_workers:
+            if bag is not None and worker.bag is bag:
+                worker.wait()
+
+    def isCurrentWorker(self):
+        """Whether the signal being handled comes from a worker that was not cancelled."""
+        return self.sender() in self.workers and not self.sender().isCancelled()
+
+    def workerProgress(self, done, total):
+        if self.isCurrentWorker():
+            self.progressBar.setVisible(True)
+            self.progressBar.setRange(0, total)
+            self.progressBar.setValue(done)
+
+    def workerFailed(self, error):
+        if self.isCurrentWorker():
+            logger.error(error)
+
+    def workerFinished(self):
+        if self.sender() in self.workers:
+            self.workers.remove(self.sender())
+        if self.sender() in self.cancelled_workers:
+            self.cancelled_workers.remove(self.sender())
+        if not len(self.workers):
+            self.progressBar.setVisible(False)
+
+    def openFile(self):
+        bagfileNames,_ = QFileDialog.getOpenFileNames(self, "Open Bag", QDir.currentPath(),"*.bag")
+        if len(bagfileNames):
+            # a chunk of a split bag (see "rosbag record --split") opens all the chunks.
+            if len(bagfileNames) == 1:
+                bagfileNames = splitBagFiles(bagfileNames[0])
+            self.cancelWorkers()
+            self.player.setFrameTimes(np.zeros(0))
+            self.frame_source = None
+            self.openButton.setEnabled(False)
+            self.startWorker(self.readBag, self.bagOpened, bagfileNames)
+
+    def readBag(self, worker, bagfileNames):
+        """Opens the bags as a single one (see bag_session.py) and reads their metadata.
+        Runs in background (see openFile)."""
+        result = {"bagfileNames": bagfileNames}
+        try:
+            result["bag"] = BagSession(bagfileNames, self.cache, progress=worker.reportProgress)
+        except Exception as e:
+            logger.error(str(e))
+            return result
+        if worker.isCancelled():
+            result["bag"].close()
+            return result
+        #Get bag metadata
+        with instrumentation.span("bag metadata"):
+            result["metadata"] = get_bag_metadata(result["bag"], self.cache)
+        return result
+
+    def bagOpened(self, result):
+        self.openButton.setEnabled(True)
+        if not self.isCurrentWorker():
+            return
+        if "bag" not in result:
+            self.errorMessages(0)
+            return
+
+        if self.bag is not None:
+            self.waitForBagWorkers(self.bag)
+            self.bag.close()
+        self.bag = result["bag"]
+        self.bagfileName = self.bag.filename
+        (self.message_count,self.duration, self.topics,
+         self.compressedImageTopics,compressed, framerate) = result["metadata"]
+
+        logger.info("TOPICS FOUND:") #TODO: try catch the case where theres no topics. Potential fatal error.
+        for top in self.topics:
+            # the frequency is not shown here, since it is computed from all the msgs of the topic.
+            logger.info("\t- " + top["topic"] + "\n\t\t-Type: "+
+                                               top["type"]+"\n\t\t-Msgs: "+ str(top["messages"]))
+        logger.info("BAG TOTAL DURATION: " + str(self.duration))
+        self.topics_combo_box.blockSignals(True)
+        self.topics_combo_box.clear()
+        self.topics_combo_box.blockSignals(False)
+        if len(self.compressedImageTopics):
+            self.topics_combo_box.addItems(self.compressedImageTopics)
+            self.reloadButton.setEnabled(True)
+        else:
+            self.errorMessages(6)
+            return
+        self.isBagLoaded = True
+        self.reset()
 
     def process_windows(self):
         if self.w_overlap_value:
             self.win_phase = (self.wsize_value*self.w_overlap_value)/100.0       ##Determined by cross-multiplication
         else:
             self.win_phase = self.wsize_value           #TODO: is there a better way to have 0 overlap?ssss
-        counter = 0.0
-
-        self.windows_begin_end_times = []
-        while (counter < self.time_buff_secs[-1] and counter+self.wsize_value < self.time_buff_secs[-1]):
-            self.windows_begin_end_times.append((counter, counter + self.wsize_value))     #Tuple-0: Begining - Tuple-1:End
-            counter += self.win_phase
-        logger.info("START_TIMES: " + str([self.windows_begin_end_times[i][0] for i in range(len(self.windows_begin_end_times))]))
-        logger.info("END_TIMES: " + str([self.windows_begin_end_times[i][1] for i in range(len(self.windows_begin_end_times))]))
+
+        # The windows are computed in nsecs (int64), as integer multiples of the phase, so their
+        # boundaries do not drift as they would by repeatedly adding the phase as a float.
+        # The windows must end before the last frame. Tuple-0: Begining - Tuple-1:End
+        phase_ns = int(round(self.win_phase * 1e9))
+        size_ns = int(round(self.wsize_value * 1e9))
+        last_ns = int(self.frame_source.stamps[-1] - self.frame_source.stamps[0])
+        if phase_ns <= 0 or size_ns <= 0:
+            # e.g. a windows size of 0 secs, which gives no windows (np.arange cannot step by 0).
+            self.errorMessages(11)
+            begins_ns = np.zeros(0, dtype=np.int64)
+        else:
+            begins_ns = np.arange(0, max(last_ns - size_ns, 0), phase_ns, dtype=np.int64)
+        self.windows_ns = np.column_stack((begins_ns, begins_ns + size_ns))
+        self.windows_begin_end_times = (self.windows_ns / 1e9).tolist()
+        logger.debug("START_TIMES: " + str([self.windows_begin_end_times[i][0] for i in range(len(self.windows_begin_end_times))]))
+        logger.debug("END_TIMES: " + str([self.windows_begin_end_times[i][1] for i in range(len(self.windows_begin_end_times))]))
         logger.info("NUMBER OR WINDOWS: " + str(len(self.windows_begin_end_times)))
 
         self.data["windows_interval"] = self.windows_begin_end_times
+        # [first, end) range of the frames of each window: the frames arriving in [begin, end).
+        self.window_frames = self.windowRanges(self.frame_source.stamps)
+        # [first, end) range of the msgs of each window, for each topic of the tree. As in the
+        # exported csv files, the msg times are relative to the first msg of their topic.
+        self.window_msgs = dict((topic, self.windowRanges(stamps)) for topic, stamps in self.topic_stamps.items())
 
         self.number_of_windows = len(self.windows_begin_end_times)
         self.listOftaggedWindows = []
         self.windows_combo_box.clear()
-        for w in range(self.number_of_windows):
-            self.windows_combo_box.addItem(str(w))
+        self.windows_combo_box.addItems([str(w) for w in range(self.number_of_windows)])
 
         self.loadOutputFiles()
 
@@ -651,104 +861,133 @@ class VideoPlayer(QWidget):
         self.topics_to_save = {}
         self.tree_of_topics.setEnabled(True)
 
+    def windowRanges(self, stamps):
+        """Returns the [first, end) range of the indexes of the stamps (sorted int64 nsecs,
+        relative to stamps[0]) in each window, as a (number of windows, 2) array."""
+        if not len(stamps):
+            return np.zeros(self.windows_ns.shape, dtype=np.int64)
+        return np.searchsorted(stamps - stamps[0], self.windows_ns, side='left')
+
     def loadImageTopic(self, topic_name):
-        (imageBuffer, self.time_buff_secs) = self.buffer_data(self.bag, image_topic=topic_name)
+        """Prepares the image topic in background: the topic is indexed (see buffer_data),
+        which allows to browse, play and tag the windows."""
+        self.player.setFrameTimes(np.zeros(0))
+        self.frame_source = None
+        self.playButton.setEnabled(False)
+        # the indexing of the previous image topic is not needed anymore, but it must stop
+        # reading the bag before the new one starts.
+        self.cancelWorkers()
+        self.waitForBagWorkers(self.bag)
+        self.startWorker(self.indexImageTopic, self.imageTopicIndexed, topic_name, bag=self.bag)
+
+    def indexImageTopic(self, worker, topic_name):
+        """Runs in background. See loadImageTopic."""
+        for top in self.topics:
+            if top["topic"] == topic_name:
+                logger.info("IMAGE TOPIC: " + topic_name + "\n\t\t-Fps: " + str(top["frequency"]))
+        frame_source, times_secs, dictionary = self.buffer_data(self.bag, image_topic=topic_name)
+        # the times of the msgs of the topics of the tree, read from the bag index. See process_windows.
+        topic_stamps = {}
+        for n, topic in enumerate(dictionary.keys()):
+            if worker.isCancelled():
+                return None
+            worker.reportProgress(n, len(dictionary))
+            topic_stamps[topic] = self.bag.entries([topic])[0]
+        return (topic_name, frame_source, times_secs, dictionary, topic_stamps)
+
+    def imageTopicIndexed(self, result):
+        if not self.isCurrentWorker():
+            return
+        (topic_name, self.frame_source, self.time_buff_secs, self.data["topics"], self.topic_stamps) = result
+        self.addToTree(self.tree_of_topics, self.data["topics"])
+        self.player.setFrameTimes(self.time_buff_secs, self.frame_source.played)
+        self.positionSlider.setRange(0, int(self.time_buff_secs[-1] * 1000))
         self.process_windows()
-        fourcc = cv2.VideoWriter_fourcc('X', 'V' ,'I', 'D')
-        height, width, bytesPerComponent = imageBuffer[0].shape
-        video_writer = cv2.VideoWriter(self.bagfileName[:-4]+".avi", fourcc, framerate, (width,height), cv2.IMREAD_COLOR)
+        self.startJournal(topic_name)
+
+        self.previousDWindowButton.setEnabled(True)
+        self.nexstDWindowButton.setEnabled(True)
+        self.playButton.setEnabled(True)
+        self.saveButton.setEnabled(True)
+        for b in self.tag_buttons.keys():
+            self.tag_buttons[b].setEnabled(True)
+        self.windowsComboxChanged()
+        instrumentation.report("image topic " + topic_name)
+
+    def journalPath(self, topic_name):
+        """The journal of the annotation of the image topic of the bags, in the cache directory."""
+        key = self.cache.key(*[os.path.abspath(f) for f in self.bag.filenames] + [topic_name])
+        return os.path.join(self.cache.directory, "journals", key + ".jsonl")
+
+    def startJournal(self, topic_name):
+        """Starts the journal of the annotation session (see annotation_journal.py). If the
+        journal of the last session has tags that were not saved, the user can recover them."""
+        if self.journal is not None:
+            self.journal.close()
+        path = self.journalPath(topic_name)
+        recovered = replayJournal(path)
+        if recovered is not None and recovered[3]:
+            (data, tagged, filename, unsaved) = recovered
+            if self.annotationLayout(data) == self.annotationLayout(self.data):
+                msg = ("The annotation of " + str(len(tagged)) + " windows of this bag was not saved in the "
+                       "last session. Do you want to recover it?")
+                reply = QMessageBox.question(self, 'Recover annotation', msg, QMessageBox.Yes, QMessageBox.No)
+                if reply == QMessageBox.Yes:
+                    self.data = data
+                    self.listOftaggedWindows = tagged
+                    self.filename = filename
+                    self.journal = AnnotationJournal(path)
+                    self.logWindowsTagged.setText(str(self.listOftaggedWindows))
+                    self.setWindowTitle('*' + (self.filename or ' UNTITLED ') + '-' + __file__)
+                    logger.info("ANNOTATION OF " + str(len(tagged)) + " WINDOWS RECOVERED FROM " + path)
+                    return
+            else:
+                # the windows or the labels of the last session are different, so it cannot be recovered here.
+                os.rename(path, path + ".old")
+                logger.warning("The unsaved annotation of the last session (windows size: " + str(data.get("win_size")) +
+                               ", overlap: " + str(data.get("overlap")) + ", sources: " + str(data.get("sources")) +
+                               ") was moved to " + path + ".old")
+        self.journal = AnnotationJournal(path, self.data)
+
+    def annotationLayout(self, data):
+        """The settings of an annotation (windows, image topic, sources and their labels) that
+        must match for its tags to be recovered into this session."""
+        settings = [data.get(k) for k in ("win_size", "overlap", "number_windows", "used_image_topic")]
+        # the labels are a tuple in the session and a list once read from the journal.
+        sources = sorted((s, list(data.get(s, {}).get("labels", ()))) for s in data.get("sources", []))
+        return settings, sources
+
+    def frameChanged(self, i):
+        """Shows the i-th frame of the image topic (see FramePlayer) and its time. The frames
+        are played at the proxy resolution, and shown at the full one when the player is paused."""
+        self.showFrame(i, not self.player.isPlaying())
+        position = int(self.time_buff_secs[i] * 1000)
+        self.duration_label.setText(str((int)((position / 1000) / 60)).zfill(2) + ":" + str((int)(position / 1000) % 60).zfill(2))
+        self.positionSlider.setValue(position)
 
-        if not video_writer.isOpened():
-            self.errorMessages(2)
-        else:
-            for frame in imageBuffer:
-                video_writer.write(frame)
-            video_writer.release()
-
-            self.mediaPlayer.setMedia(QMediaContent(QUrl.fromLocalFile(self.bagfileName[:-4]+".avi")))
-            self.playButton.setEnabled(True)
-            self.previousDWindowButton.setEnabled(True)
-            self.nexstDWindowButton.setEnabled(True)
-            self.saveButton.setEnabled(True)
-            for b in self.tag_buttons.keys():
-                self.tag_buttons[b].setEnabled(True)
+    def showFrame(self, i, full=False):
+        """Shows the i-th frame of the image topic, at its full resolution or as a proxy (see FrameSource)."""
+        if self.frame_source is not None:
+            # the frames are decoded as BGRA, the layout of QImage.Format_RGB32, so they are painted as they are.
+            frame = self.frame_source.fullFrame(i) if full else self.frame_source.frame(i)
+            with instrumentation.span("show frame", items=1):
+                self.videoWidget.showImage(frame)
 
     def buffer_data(self, bag, image_topic, compressed=True):
-        img_buff = []
-        img_time_buff_secs = []
-        bridge = CvBridge()
-        self.bag_buffers = {}
-
-        for t_name in [top["topic"] for top in self.topics]:
-            self.bag_buffers[t_name] = {}
-            self.bag_buffers[t_name]["msg"] = []
-            self.bag_buffers[t_name]["s_time"] = None
-            self.bag_buffers[t_name]["time_buffer_secs"] = []
-
-        # Buffer the images, timestamps from the rosbag
-        for topic, msg, t in bag.read_messages():  # topics=[input_topic]):
-
-            if self.bag_buffers[topic]["s_time"] is None:
-                self.bag_buffers[topic]["s_time"] = t
-
-            # Get the image
-            if topic == image_topic:
-                if not compressed:
-                    try:
-                        cv_image = bridge.imgmsg_to_cv2(msg, "bgr8")
-                    except CvBridgeError as e:
-                        print e
-                else:
-                    nparr = np.fromstring(msg.data, np.uint8)
-                    cv_image = cv2.imdecode(nparr, 1)  #### cv2.CV_LOAD_IMAGE_COLOR has as enum value 1.
-                    ## TODO: fix the problem with the this enum value.
-
-                img_buff.append(cv_image)
-                img_time_buff_secs.append(t.to_sec() - self.bag_buffers[topic]["s_time"].to_sec())
-
-            self.bag_buffers[topic]["msg"].append(msg)
-            self.bag_buffers[topic]["time_buffer_secs"].append(t.to_sec() - self.bag_buffers[topic]["s_time"].to_sec())
-
-        self.types = {}
-        dictionary = {}
-        for k in self.bag_buffers.keys():
-            if k not in self.compressedImageTopics:
-                if not self.bag_buffers[k]["msg"][0]._type in self.types:
-                    self.types[self.bag_buffers[k]["msg"][0]._type] = self.makeTopicDictionary(self.bag_buffers[k]["msg"][0],dictionary)
-                    dictionary = {}
-
+        """Indexes the image topic and builds the dictionary of topics (shown in the tree of
+        topics). No msg is read here: the returned FrameSource decodes the frames when they
+        are requested, and the tree is built from the msg types (see topic_schema.py).
+        Returns the frame source, the time of each frame (in secs) and the dictionary of topics."""
+        # the frames played are kept in the cache, see frame_store.py.
+        frame_source = FrameSource(bag, image_topic, compressed, conversion=cv2.COLOR_BGR2BGRA, store_cache=self.cache)
 
-        dictionary = {}
-        for top in self.topics:
-            for type in self.types.keys():
-                if top["type"] == type:
-                    dictionary[top["topic"]] = self.types[type]
-
-        self.data["topics"] = dictionary
-        self.addToTree(self.tree_of_topics,self.data["topics"])
-        #logger.debug(json.dumps(self.types, indent=4, sort_keys=True))
-        return img_buff, img_time_buff_secs
-
-    def isPrimitive(self,obj):
-        """ __slots__ gives the list of fields in the msg. It a message doesn't have it,
-        it is reasonable to say it doesn't contain fields on it, thus, it is a primitive
-        type"""
-        return not hasattr(obj, '__slots__')
-
-    def makeTopicDictionary(self,root, dictionary):
-        if not self.isPrimitive(root):
-            for s in root.__slots__:
-                if not s.startswith("header"):
-                    if self.isPrimitive(getattr(root,s)):
-                        dictionary = self.makeTopicDictionary(s, dictionary)
-                    else:
-                        newDict ={}
-                        dictionary[s] = self.makeTopicDictionary(getattr(root,s),newDict)
-        else:
-            dictionary[root] = []
-
-        return dictionary
+        # The tree of each topic is built from the definition of its msg type (see topic_schema.py),
+        # so the msgs of the other topics are not read.
+        topics = [top["topic"] for top in self.topics if top["topic"] not in self.compressedImageTopics]
+        dictionary = self.schemas.topicTrees(bag, topics)
 
+        #logger.debug(json.dumps(dictionary, indent=4, sort_keys=True))
+        return frame_source, frame_source.times_secs, dictionary
 
     #Open CSV file
     def openCsv(self):
@@ -789,14 +1028,14 @@ class VideoPlayer(QWidget):
         elif index == 10:
             msgBox.setText('You must select at least one topic in the check box tree! '
                            'Tip: check the item but also click on its name')
+        elif index == 11:
+            msgBox.setText('Error: the windows size and step must be greater than 0 secs! '
+                           'Change the windows size or the overlap and reload the bag')
         msgBox.resize(100,40)
         msgBox.exec_()
 
     def play(self):
-        if self.mediaPlayer.state() == QMediaPlayer.PlayingState:
-            self.mediaPlayer.pause()
-        else:
-            self.mediaPlayer.play()
+        self.player.toggle()
 
     def moveWindowForward(self):
         curr = self.windows_combo_box.currentText()
@@ -814,36 +1053,14 @@ class VideoPlayer(QWidget):
                 self.windows_combo_box.setCurrentIndex(curr-1)
                 self.windowsComboxChanged()
 
-    def mediaStateChanged(self, state):
-        if state == QMediaPlayer.PlayingState:
+    def playerStateChanged(self, playing):
+        if playing:
             self.playButton.setIcon(self.style().standardIcon(QStyle.SP_MediaPause))
         else:
             self.playButton.setIcon(self.style().standardIcon(QStyle.SP_MediaPlay))
-
-    def positionChanged(self, position):
-        self.duration_label.setText(str((int)((position / 1000) / 60)).zfill(2) + ":" + str((int)(position / 1000) % 60).zfill(2))
-        if self.current_begin_mismatch >= self.WINDOWS_MISMATCH_TOLERANCE:
-            logger.error("STARTING OUT OF THE WINDOW START TIME! Deviation of: " + str(self.current_begin_mismatch) 
-                + " above the tolerance ("+ str(self.WINDOWS_MISMATCH_TOLERANCE)+ ")")
-
-        if float(position / 1000) >= self.windows_begin_end_times[int(self.windows_combo_box.currentText())][1]:
-            stop_deviation = abs(float(position / 1000) - self.windows_begin_end_times[int(self.windows_combo_box.currentText())][1])
-            if stop_deviation >= self.WINDOWS_MISMATCH_TOLERANCE:
-                logger.error("ENDING OUT OF THE WINDOW END BOUNDARY! Deviation of: " + str(stop_deviation) 
-                + " above the tolerance ("+ str(self.WINDOWS_MISMATCH_TOLERANCE)+ ")")
-            else:
-                logger.info("SLIDING DEVIATION SUMMARY (WIN#"+self.windows_combo_box.currentText()+" TOLERANCE OF "
-                            + str(self.WINDOWS_MISMATCH_TOLERANCE)+"secs) At_start: "+
-                            str(self.current_begin_mismatch)+"secs\tAt_end: " +str(stop_deviation)+'secs <-- OK')
-
-            self.current_begin_mismatch = -1
-            millis = self.windows_begin_end_times[int(self.windows_combo_box.currentText())][0] * 1000
-            self.updateSliderPosition(millis)
-
-        elif self.current_begin_mismatch == -1:
-            self.current_begin_mismatch = abs(float(position / 1000) - self.windows_begin_end_times[int(self.windows_combo_box.currentText())][0])
-
-        self.positionSlider.setValue(position)
+            # the frame the player stopped at is shown at its full resolution.
+            if self.player.current >= 0:
+                self.showFrame(self.player.current, True)
 
     def keyPressEvent(self,event):
         if event.key() == Qt.Key_Control:
@@ -853,32 +1070,24 @@ class VideoPlayer(QWidget):
         if event.key() == Qt.Key_Control:
             self.controlEnabled = False
 
-    def durationChanged(self, duration):
-        self.positionSlider.setRange(0, duration)
-
-    def updateSliderPosition(self, position):
-        global frameCounter
-        frameCounter = int(round(self.message_count * position / (self.duration * 1000)))
-        self.mediaPlayer.setPosition(position)
-
     def setPosition(self):
         self.errorMessages(8)
 
     def saveAs(self):
         defaultdir = os.path.dirname(os.path.abspath(__file__))
-        defaultname = self.bagfileName.split("/")[-1][:-4] + ".json"
+        defaultname = sessionName(self.bag.filenames) + ".json"
         insertedName = QFileDialog.getSaveFileName(self, 'Save File', defaultdir+"/"+defaultname, filter='*.json')
         if insertedName[0] != '':
             self.filename = insertedName[0]
-            with open(self.filename, "w") as save_file:
-                json.dump(self.data, save_file, indent=4, sort_keys=True)
+            compactJournal(self.data, self.filename)
+            self.journal.saved(self.filename)
             self.isUnsave = False
             self.setWindowTitle(self.filename + '-' + __file__)
 
     def save(self):
         if self.filename != '':
-            with open(self.filename, "w") as save_file:
-                json.dump(self.data, save_file, indent=4, sort_keys=True)
+            compactJournal(self.data, self.filename)
+            self.journal.saved(self.filename)
             self.isUnsave = False
             self.setWindowTitle(self.filename + '-' + __file__)
         else:
@@ -894,6 +1103,16 @@ class VideoPlayer(QWidget):
                     event.accept()
                 else:
                     event.ignore()
+        if event.isAccepted():
+            self.player.pause()
+            self.cancelWorkers(wait=True)
+            for worker in self.cancelled_workers:
+                worker.wait()
+            if self.journal is not None:
+                self.journal.close()
+            if self.frame_source is not None:
+                self.frame_source.close()
+            instrumentation.dump(LOG_DIR, "annotator")
 
 
 
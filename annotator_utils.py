@@ -1,34 +1,36 @@
 from cv_bridge import CvBridge, CvBridgeError
 import numpy as np
-import yaml, csv, os, cv2
+import csv, os, cv2
 import sys
+import errno
+import threading
+from collections import deque
 from PyQt5 import QtCore
 import logging
+import logging.handlers
+from file_cache import DEFAULT_CACHE_DIR
+from bag_metadata import BagMetadata
+from frame_source import parallelDecode, decodeImage, DEFAULT_DECODE_THREADS
 
-def buffer_data(bag, input_topic, compressed):
-    image_buff = []
+LOG_MAX_LINES = 5000            # records kept by the log areas (the oldest ones are removed).
+LOG_FLUSH_INTERVAL_MS = 100     # the log areas are updated at most every LOG_FLUSH_INTERVAL_MS.
+# directory of the trace files (see traceFileHandler).
+LOG_DIR = os.environ.get("ROSBAG_ANNOTATOR_LOG_DIR", os.path.join(DEFAULT_CACHE_DIR, "logs"))
+
+def buffer_data(bag, input_topic, compressed, threads=DEFAULT_DECODE_THREADS):
     time_buff  = []
-    start_time = None
+    start_time = [None]
     bridge     = CvBridge()
 
-    #Buffer the images, timestamps from the rosbag
-    for topic, msg, t in bag.read_messages(topics=[input_topic]):
-        if start_time is None:
-            start_time = t
-
-        #Get the image
-        if not compressed:
-            try:
-                cv_image = bridge.imgmsg_to_cv2(msg, "bgr8")
-            except CvBridgeError as e:
-                print e
-        else:
-            nparr = np.fromstring(msg.data, np.uint8)
-            cv_image = cv2.imdecode(nparr, 1) #### cv2.CV_LOAD_IMAGE_COLOR has as enum value 1.
-            ## TODO: fix the problem with the this enum value.
+    def messages():
+        for topic, msg, t in bag.read_messages(topics=[input_topic]):
+            if start_time[0] is None:
+                start_time[0] = t
+            time_buff.append(t.to_sec() - start_time[0].to_sec())
+            yield msg
 
-        image_buff.append(cv_image)
-        time_buff.append(t.to_sec() - start_time.to_sec())
+    #Buffer the images, timestamps from the rosbag. The images are decoded by a pool of threads.
+    image_buff = list(parallelDecode(lambda msg: decodeImage(msg, compressed, bridge), messages(), threads))
 
     return image_buff,  time_buff
 
@@ -65,22 +67,16 @@ def buffer_csv(csv_file):
     else:
         return False,False,False
 
-def get_bag_metadata(bag):
-    info_dict       = yaml.load(bag._get_yaml_info())
-    topics             = info_dict['topics']
+def get_bag_metadata(bag, cache=None):
+    """Reads the bag metadata from its index (see bag_metadata.py). The frequency of the
+    topics is computed when it is first accessed, and kept in cache (a FileCache), if given."""
+    metadata       = BagMetadata(bag, cache)
+    topics             = metadata.topics
     topic            = topics[0]
-    duration       = info_dict['duration']
+    duration       = metadata.duration
     topic_type       = topic['type']
     message_count = topic['messages']
-    compressedImageTopics = []
-
-    #Messages for test
-    #print "\nRosbag topics found: "
-    for top in topics:
-        if top["type"].endswith("sensor_msgs/CompressedImage"):
-            compressedImageTopics.append(top["topic"])
-        #print "\t- ", top["topic"], "\n\t\t-Type: ", top["type"],"\n\t\t-Fps: ", top["frequency"]
-
+    compressedImageTopics = metadata.topicsOfType("sensor_msgs/CompressedImage")
 
     #Checking if the topic is compressed
     if len(compressedImageTopics): #if there is something in the list, so there is compressed topics
@@ -93,26 +89,76 @@ def get_bag_metadata(bag):
 
     return message_count, duration, topics, compressedImageTopics, compressed, framerate
 
+def traceFileHandler(name, max_bytes=10 * 1024 * 1024, backup_count=3):
+    """Returns a handler writing all the log records, including the verbose DEBUG ones (e.g.
+    the details of each window) that are not shown in the log areas, to LOG_DIR/name.log.
+    The file is rotated when it reaches max_bytes, keeping backup_count old files."""
+    try:
+        os.makedirs(LOG_DIR)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            return logging.NullHandler()
+    handler = logging.handlers.RotatingFileHandler(os.path.join(LOG_DIR, name + ".log"),
+                                                   maxBytes=max_bytes, backupCount=backup_count)
+    handler.setLevel(logging.DEBUG)
+    return handler
+
+def treeItemValue(dictionary, item):
+    """Returns the value of the dictionary of topics (see topic_schema.py) shown by an item of
+    the tree of topics, following the names of the item and of its parents."""
+    path = []
+    while item is not None:
+        path.append(item.text(0))
+        item = item.parent()
+    for name in reversed(path):
+        dictionary = dictionary[name]
+    return dictionary
+
 ### classes from http://stackoverflow.com/questions/24469662/how-to-redirect-logger-output-into-pyqt-text-widget
 class QtHandler(logging.Handler):
+    """Writes the log records to the XStream shown in the log areas. Only the INFO (and
+    above) records are shown, the DEBUG ones go to the trace file (see traceFileHandler)."""
     def __init__(self):
         logging.Handler.__init__(self)
+        self.setLevel(logging.INFO)
     def emit(self, record):
         record = self.format(record)
         if record: XStream.stdout().write('%s\n'%record)
         # originally: XStream.stdout().write("{}\n".format(record))
 
 class XStream(QtCore.QObject):
+    """Stream sending the text written to it by the messageWritten signal. The text is
+    buffered and sent in batches, every LOG_FLUSH_INTERVAL_MS, so a burst of log records
+    updates the log areas once. At most LOG_MAX_LINES writes are buffered, since the log
+    areas do not keep more than that (see setMaximumBlockCount). It can be written from
+    any thread."""
     _stdout = None
     _stderr = None
     messageWritten = QtCore.pyqtSignal(str)
+    def __init__( self ):
+        super(XStream, self).__init__()
+        self.lock = threading.Lock()
+        self.buffer = deque(maxlen=LOG_MAX_LINES)
+        self.dropped = 0
+        self.timer = QtCore.QTimer(self)
+        self.timer.timeout.connect(self.flush)
+        self.timer.start(LOG_FLUSH_INTERVAL_MS)
     def flush( self ):
-        pass
+        with self.lock:
+            msgs, dropped = list(self.buffer), self.dropped
+            self.buffer.clear()
+            self.dropped = 0
+        if len(msgs) and not self.signalsBlocked():
+            if dropped:
+                msgs.insert(0, "... %d log records not shown (see the trace file in %s)\n" % (dropped, LOG_DIR))
+            self.messageWritten.emit(unicode("".join(msgs).rstrip("\n")))
     def fileno( self ):
         return -1
     def write( self, msg ):
-        if ( not self.signalsBlocked() ):
-            self.messageWritten.emit(unicode(msg))
+        with self.lock:
+            if len(self.buffer) == self.buffer.maxlen:
+                self.dropped += 1
+            self.buffer.append(msg)
     @staticmethod
     def stdout():
         if ( not XStream._stdout ):
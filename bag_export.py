@@ -0,0 +1,464 @@
+# -*- coding: utf-8 -*-
+# This module holds the data export of the annotation parser. It extracts the
+# data of the selected topics from the bag, slices it according to the windows
+# described in the annotation json (generated by the "annotator.py" program)
+# and writes it into one csv file (or another format, see export_writers.py)
+# per feature perspective (source). It does
+# not depend on Qt, so it is shared by the "annotation_parser.py" interface and
+# the headless "batch_export.py" command line tool.
+
+import copy
+import bisect
+import logging
+import operator
+import numpy as np
+from export_writers import createWriter
+from bag_session import nsecToSec
+import instrumentation
+
+logger = logging.getLogger(__name__)
+
+RANGE_MARGIN_NSECS = 1000000    # margin of the time ranges read (see taggedRanges), for the float rounding.
+
+
+def expandTopicSelection(topics, selection):
+    """Returns the list of selected headers (topic name followed by the attribute names,
+    separated by ".") as the tree of topics of the annotation parser would give it.
+        topics      :   the "topics" dictionary of the annotation json (nested dictionary
+                        whose leaves, the primitive attributes, are empty lists).
+        selection   :   list of headers and/or topic names. A topic name (or any
+                        intermediate attribute) selects all the attributes below it.
+    """
+    def leaves(dictionary, prefix):
+        if isinstance(dictionary, dict) and len(dictionary):
+            result = []
+            for k in sorted(dictionary.keys()):
+                result += leaves(dictionary[k], prefix + "." + k if prefix else k)
+            return result
+        return [prefix]
+
+    allHeaders = leaves(topics, '')
+    headers = []
+    for item in selection:
+        matching = [h for h in allHeaders if h == item or h.startswith(item + ".")]
+        if not len(matching):
+            raise ValueError("'" + item + "' is not a topic (or topic attribute) of the annotation file")
+        headers += [h for h in matching if h not in headers]
+    return headers
+
+
+class BagExporter(object):
+    """Exports the windows of an annotation json from a loaded bag.
+        bag                 :   the BagSession of the bag files (see bag_session.py).
+        annotation          :   the annotation json content (dictionary).
+        headers             :   the selected topics, as the topic name followed by the
+                                attribute names separated by "." (see expandTopicSelection).
+                                They are also the names of the data columns in the csv files.
+        mismatchTolerance   :   tolerance value for deviation in the windows slice.
+    """
+
+    def __init__(self, bag, annotation, headers, mismatchTolerance=0.02):
+        self.bag = bag
+        self.annotationDictionary = annotation
+        self.topicSelectionONHeaders = list(headers)
+        self.mismatchTolerance = mismatchTolerance
+
+        # holds which topics are selected and their selected attributes.
+        self.topicSelectionON = {}
+        for header in self.topicSelectionONHeaders:
+            selectionParts = header.split(".")
+            self.topicSelectionON.setdefault(selectionParts[0], []).append(".".join(selectionParts[1:]))
+
+        # the list of tuples (start, end) representing the windows interval.
+        self.windowsInterval = [(w[0], w[1]) for w in self.annotationDictionary["windows_interval"]]
+
+        self.bag_data = {}              # see loadBagData method.
+        self.writers = {}               # the output writer of each source. See openOutputFiles.
+        self.msg_count = 0              # number of msgs read from the bag.
+        self.row_count = 0              # number of data rows written (for all sources).
+        self.extractors = {}            # compiled extractors by (topic, msg type). See getExtractor.
+        self.ranged = True              # whether only the ranges of the tagged windows are read. See taggedRanges.
+
+    def openOutputFiles(self, filename, format="csv"):
+        """Creates one output file of the given format (see export_writers.py) for each feature
+        perspective (source), named as the given filename followed by the source name. Returns
+        the list of created file names."""
+        if filename.endswith(".csv"):
+            filename = filename[:-4]     #remove .csv
+
+        filenames = []
+        self.writers = {}
+        #loop through perspectives.
+        for s_name in self.annotationDictionary["sources"]:
+            # define the headers for the output files (variable, column, names).
+            columns = ["time"] + list(self.annotationDictionary[s_name]["labels"]) + self.topicSelectionONHeaders
+            # append to the filename the feature perspective name
+            self.writers[s_name], output_name = createWriter(format, filename + "_" + s_name, columns)
+            filenames.append(output_name)
+        return filenames
+
+    def closeOutputFiles(self):
+        """Closes the output files opened by openOutputFiles."""
+        for writer in self.writers.values():
+            writer.close()
+        self.writers = {}
+
+    def export(self, filename, streaming=False, format="csv", ranged=True):
+        """Exports the windows data into the output files (see openOutputFiles). In the streaming
+        mode, the data is read from the bag while the windows are written (see streamData).
+        Without ranged, all the msgs of the selected topics are read, not only those of the
+        tagged windows (the output is the same). Returns the list of created file names."""
+        self.ranged = ranged
+        if not streaming:
+            self.loadBagData()
+        filenames = self.openOutputFiles(filename, format)
+        try:
+            if streaming:
+                self.streamData()
+            else:
+                self.writeData()
+        finally:
+            self.closeOutputFiles()
+        return filenames
+
+    def loadBagData(self):
+        """Sets the bag_data dictionary with with the content of the
+        selected topics in the loaded bag. Only the msgs of the tagged windows are
+        read (see taggedMessages).
+            self.bag_data[topicName]["msg"] : list of msgs in the bag for the
+                                              the given topic (topicName).
+            self.bag_data[topiName]["s_time"] : time (in secs) of the first msg in the
+                                                bag for the given topic
+            self.bag_data[topicName]["time_buffer_secs"] : list of msg arrival times (in secs)
+                                                            for the given bag.
+        """
+        self.bag_data = {}
+        # the start time of each topic is read from the bag index.
+        s_times, _ = self.getTopicStartTimes(self.topicSelectionON.keys())
+
+        for t_name in self.topicSelectionON.keys():
+            # define msg structure. See method stringdoc.
+            self.bag_data[t_name] = {}
+            self.bag_data[t_name]["msg"] = []
+            self.bag_data[t_name]["s_time"] = s_times.get(t_name)
+            self.bag_data[t_name]["time_buffer_secs"] = []
+
+        # Buffer the msgs, timestamps from the rosbag
+        for topic, msg, t in instrumentation.timed("bag read", self.taggedMessages(self.topicSelectionON.keys())):
+            self.msg_count += 1
+            try:
+                self.bag_data[topic]["msg"].append(msg)             # append msg
+                # append second difference between the current time ant the s_time.
+                self.bag_data[topic]["time_buffer_secs"].append(t.to_sec() - self.bag_data[topic]["s_time"])
+            except:
+                logger.debug("Error: " + topic)
+
+    def taggedRanges(self, topics):
+        """Returns the time ranges of the bag (sorted list of [start, end] in nsecs) holding the
+        msgs of the tagged windows for the given topics. The windows times are relative to the
+        first msg of each topic, so a window covers the range from its start after the earliest
+        topic start to its end after the latest one. Overlapping ranges are merged. Without
+        self.ranged, the single range is the whole bag from the earliest topic start."""
+        starts = [start for start in [self.bag.topicStartTime(topicName) for topicName in topics] if start is not None]
+        if not len(starts):
+            return []
+        first, last = min(starts), max(starts)
+        if not self.ranged:
+            return [[first, int(self.bag.get_end_time() * 1e9) + RANGE_MARGIN_NSECS]]
+        ranges = []
+        for t, (start, end) in enumerate(self.windowsInterval):
+            if not self.isWindowTagged(t):
+                continue
+            begin_ns = first + int(start * 1e9) - RANGE_MARGIN_NSECS
+            end_ns = last + int(end * 1e9) + RANGE_MARGIN_NSECS
+            if len(ranges) and begin_ns <= ranges[-1][1]:
+                ranges[-1][1] = max(ranges[-1][1], end_ns)
+            else:
+                ranges.append([begin_ns, end_ns])
+        return ranges
+
+    def taggedMessages(self, topics, ranges=None):
+        """Generator of the (topic, msg, time) tuples of the msgs of the given topics in the
+        ranges of the tagged windows (see taggedRanges, unless the ranges are given), sorted by
+        time. Only the bag chunks of these ranges are read, so the reading time goes with the
+        tagged duration."""
+        if ranges is None:
+            ranges = self.taggedRanges(topics)
+        logger.info("Reading " + str(len(ranges)) + " time ranges of the tagged windows (" +
+                    "%.1f" % (sum(end - begin for begin, end in ranges) / 1e9) + " secs)")
+        return self.bag.readRanges(topics, ranges)
+
+    def rangeCounts(self, topics, ranges):
+        """Returns the number of msgs of each one of the given topics in the time ranges (see
+        taggedRanges), as read from the bag index."""
+        begins = np.array([begin for begin, _ in ranges], dtype=np.int64)
+        ends = np.array([end for _, end in ranges], dtype=np.int64)
+        counts = {}
+        for topicName in topics:
+            stamps = self.bag.entries([topicName])[0]
+            counts[topicName] = int(np.sum(stamps.searchsorted(ends, side='right') -
+                                           stamps.searchsorted(begins, side='left')))
+        return counts
+
+    def buildTimeline(self):
+        """Merges the msg times of the selected topics (see loadBagData) into a single time
+        sorted timeline, shared by all the feature categories. It is kept as numpy arrays:
+            self.timeline_names :   the selected topics. The topic ids are their positions.
+            self.timeline_times :   the sorted (unique) times of the msgs, in secs.
+            self.timeline_topics:   topic id of each msg in the timeline, sorted by time.
+            self.timeline_msgs  :   position of each msg in the bag_data[topicName]["msg"] list.
+            self.timeline_bounds:   the msgs at timeline_times[i] are the ones in the
+                                    [timeline_bounds[i], timeline_bounds[i + 1]) range.
+        """
+        self.timeline_names = list(self.topicSelectionON.keys())
+        with instrumentation.span("timeline") as span:
+            times, topics, msgs = [], [], []
+            for i, topicName in enumerate(self.timeline_names):
+                # in case of repeated times for a topic, the first msg is kept (np.unique gives
+                # the first occurrence of each time).
+                topic_times, first = np.unique(np.array(self.bag_data[topicName]["time_buffer_secs"],
+                                                        dtype=np.float64), return_index=True)
+                times.append(topic_times)
+                topics.append(np.full(len(topic_times), i, dtype=np.int32))
+                msgs.append(first)
+            times = np.concatenate(times)
+            # stable sort: the msgs with the same time keep the order of the topics.
+            order = np.argsort(times, kind='mergesort')
+            times = times[order]
+            self.timeline_topics = np.concatenate(topics)[order]
+            self.timeline_msgs = np.concatenate(msgs)[order]
+            self.timeline_times, starts = np.unique(times, return_index=True)
+            self.timeline_bounds = np.append(starts, len(times))
+            span.add(len(times))
+
+    def timelineSamples(self, start, end):
+        """Returns the msgs of the timeline times in the [start, end) range, as the time
+        sorted list of (time, msgs) tuples taken by windowValues."""
+        names = self.timeline_names
+        bounds = self.timeline_bounds[start:end + 1]
+        topics = self.timeline_topics[bounds[0]:bounds[-1]].tolist()
+        msgs = self.timeline_msgs[bounds[0]:bounds[-1]].tolist()
+        bounds = (bounds - bounds[0]).tolist()
+        samples = []
+        for i, time in enumerate(self.timeline_times[start:end].tolist()):
+            samples.append((time, [(names[topics[j]], self.bag_data[names[topics[j]]]["msg"][msgs[j]])
+                                   for j in range(bounds[i], bounds[i + 1])]))
+        return samples
+
+    def writeData(self):
+        """This function loops through the self.bag_data["msg] data list and based on
+        the windows division (self.windowsInterval), prints the data the output files.
+        The merged timeline (see buildTimeline) and the data of each windows are shared
+        by all the feature categories, only the tags differ."""
+
+        logger.info("Aligning different time buffers...")
+        self.buildTimeline()
+
+        ##### binary search for the endpoints of all the windows in the timeline. The
+        ##### window content is the slice [starts[t], ends[t]) (both endpoints inclusive).
+        windows = np.array(self.windowsInterval, dtype=np.float64).reshape(-1, 2)
+        starts = self.timeline_times.searchsorted(windows[:, 0], side='left')
+        ends = self.timeline_times.searchsorted(windows[:, 1], side='right')
+
+        # Loops through all windows.
+        for t in range(len(windows)):
+            values = []         # windows content. See windowValues method.
+            # empty tags in the jason file do not need any data.
+            if self.isWindowTagged(t):
+                values = self.windowValues(self.timelineSamples(starts[t], ends[t]))
+            # For each feature category (tabs)
+            for s_name in self.annotationDictionary["sources"]:
+                self.writeWindow(s_name, t, values)
+
+    def getTopicStartTimes(self, topics):
+        """Returns a dictionary with the time of the first msg (in secs, as rospy gives it) and
+        the number of msgs of each one of the given topics, as read from the bag index (no msg
+        is read). Topics without msgs in the bag are left out."""
+        start_times = {}
+        msg_counts = {}
+        for topicName in topics:
+            start = self.bag.topicStartTime(topicName)
+            if start is not None:
+                # the same float the rospy time of the msg gives (see loadBagData).
+                start_times[topicName] = nsecToSec(start)
+                msg_counts[topicName] = self.bag.messageCount(topicName)
+        return start_times, msg_counts
+
+    def streamData(self):
+        """Single pass alternative to the loadBagData + writeData pair. Only the msgs of the
+        selected topics (self.topicSelectionON) are read from the bag and each window is
+        written as soon as all of its msgs have been read. The msgs are then discarded, so
+        that the memory usage is bounded by the size of a window and not by the size of the bag.
+
+        NOTE: the msg times are relative to the first msg of each topic (as in loadBagData), so
+        the msgs arrive slightly out of order with respect to these times. A window is only
+        written when every topic has moved past its end (or has no more msgs to be read)."""
+        s_times, _ = self.getTopicStartTimes(self.topicSelectionON.keys())
+        # only the msgs of the tagged windows are read (see taggedMessages).
+        ranges = self.taggedRanges(s_times.keys())
+        msg_counts = self.rangeCounts(s_times.keys(), ranges)
+        pending = []            # sorted list of (time, seq, topicName, msg) not yet written.
+        last_time = {}          # time of the last msg read for each topic.
+        for topicName in s_times.keys():
+            last_time[topicName] = float("-inf") if msg_counts[topicName] else float("inf")
+        seq = 0                 # arrival counter. Keeps the ordering stable for repeated times.
+        w = 0                   # index of the next windows to be written.
+
+        for topic, msg, t in instrumentation.timed("bag read", self.taggedMessages(s_times.keys(), ranges)):
+            self.msg_count += 1
+            time = t.to_sec() - s_times[topic]
+            msg_counts[topic] -= 1
+            # a topic with no msgs left cannot hold back any windows.
+            last_time[topic] = time if msg_counts[topic] else float("inf")
+
+            # msgs before the current windows are not used by any other windows.
+            if w < len(self.windowsInterval) and time >= self.windowsInterval[w][0]:
+                bisect.insort(pending, (time, seq, topic, msg))
+                seq += 1
+
+            watermark = min(last_time.values())
+            while w < len(self.windowsInterval) and self.windowsInterval[w][1] < watermark:
+                self.writePendingWindow(w, pending)
+                w += 1
+
+        # writes the windows left (those ending after the last msg of the bag).
+        while w < len(self.windowsInterval):
+            self.writePendingWindow(w, pending)
+            w += 1
+
+    def writePendingWindow(self, t, pending):
+        """Writes the t-th windows from the pending msgs of the streamData method (for all
+        the feature categories) and discards the msgs that are not needed anymore."""
+        start, end = self.windowsInterval[t]
+        samples = []
+        for time, _, topicName, msg in pending[bisect.bisect_left(pending, (start,)):
+                                               bisect.bisect_right(pending, (end, float("inf")))]:
+            if samples and samples[-1][0] == time:
+                # in case of repeated times for a topic, keep the first msg (see loadBagData).
+                if topicName not in [name for name, _ in samples[-1][1]]:
+                    samples[-1][1].append((topicName, msg))
+            else:
+                samples.append((time, [(topicName, msg)]))
+
+        values = self.windowValues(samples) if self.isWindowTagged(t) else []
+        for s_name in self.annotationDictionary["sources"]:
+            self.writeWindow(s_name, t, values)
+
+        # the windows are sorted, so the msgs before the next windows start can be dropped.
+        if t + 1 < len(self.windowsInterval):
+            del pending[:bisect.bisect_left(pending, (self.windowsInterval[t + 1][0],))]
+        else:
+            del pending[:]
+
+    def isWindowTagged(self, t):
+        """Whether any feature category has a tag for the t-th windows."""
+        return any(self.annotationDictionary[s_name]["tags"][t] != []
+                   for s_name in self.annotationDictionary["sources"])
+
+    def windowValues(self, samples):
+        """Retrieves the data of each selected topic (topic field) of the msgs of a windows.
+            samples :   time sorted list of (time, msgs) tuples inside the windows, where msgs is a
+                        list of (topicName, msg) tuples of the topics having a msg at that time.
+        Returns the time sorted list of (time, values) tuples, where values is a dictionary
+        with the selected attributes (headers) of the msgs at that time."""
+        values = []
+        with instrumentation.span("extract values") as span:
+            for time, msgs in samples:
+                data = {}
+                # retrieves the data of each selected topic with its compiled extractor.
+                for topicName, msg in msgs:
+                    headers, getter = self.getExtractor(topicName, msg)
+                    data.update(zip(headers, getter(msg)))
+                values.append((time, data))
+            span.add(len(values))
+        return values
+
+    def writeWindow(self, s_name, t, values):
+        """Writes the content of the t-th windows to the output file of the s_name feature category.
+            values  :   time sorted list of (time, values) tuples inside the windows (see windowValues).
+        """
+        logger.debug("Feature Category: "+ s_name + '\tWin#: ' + str(t))
+        # skip empty tag in the jason file.
+        if self.annotationDictionary[s_name]["tags"][t] == []:
+            # the window has no rows (an empty line in the csv file)
+            self.writers[s_name].writeWindow(t, [])
+            return
+
+        start, end = self.windowsInterval[t]    # start and end of the windows
+        buffer = []                             # windows row batch
+        for time, data in values:
+            # copy tag data from current window
+            row = copy.copy(self.annotationDictionary[s_name]["tags"][t])
+            # set the current time stamp for the row
+            row["time"] = time
+            # the data of the selected topics.
+            row.update(data)
+            # append row to the windows row batch
+            buffer.append(row)
+        self.row_count += len(buffer)
+
+        ##### Checks whether the deviation between the windows "begin"
+        ##### and "end" times is less the tolerance value.
+        if not len(values):
+            logger.error("No data found inside the windows! Start: " + str(start) + "\tEnd: " + str(end))
+        else:
+            retrieval_start = values[0][0]
+            retrieval_end = values[-1][0]
+            if abs(start - retrieval_start) < self.mismatchTolerance:
+                logger.debug("WStart: " + str(start) + " Retrieval start:" +
+                            str(retrieval_start) + " Sync: OK!")
+            else:
+                logger.error("Beginning of the windows is out of sync! MustBe: "+
+                             str(start) + "\tWas: " + str(retrieval_start))
+            if abs(end - retrieval_end) < self.mismatchTolerance:
+                logger.debug("WEnd: " + str(end) + " Retrieval end:" +
+                            str(retrieval_end) + " Sync: OK!")
+            else:
+                logger.error("End of the windows is out of sync! MustBe: "+
+                             str(end) + "\tWas: " + str(retrieval_end))
+
+        ##### Prints the windows content (row batch) to the corresponding (s_name) output file.
+        with instrumentation.span("write rows", items=len(buffer)):
+            self.writers[s_name].writeWindow(t, buffer)
+
+    def getExtractor(self, topicName, msg):
+        """Returns the extractor of the selected attributes of topicName for the type of
+        the given msg, compiling it the first time the type is seen (see compileExtractor)."""
+        key = (topicName, type(msg))
+        if key not in self.extractors:
+            self.extractors[key] = self.compileExtractor(topicName, msg)
+        return self.extractors[key]
+
+    def compileExtractor(self, topicName, msg, ignore=("header",)):
+        """Compiles the selected attributes of a topic into a flat extractor. The msg
+        structure is walked once, looking for the primitive attributes (those without
+        __slots__) whose header (topic name followed by the attribute names, separated
+        by ".") is in self.topicSelectionONHeaders. Returns the tuple (headers, getter),
+        where getter(msg) gives the tuple of values of the headers in a single call.
+            topicName   :   the topic name of the msg.
+            msg         :   a sample msg of the topic, used for discovering its structure.
+            ignore      :   the attribute names ignored at any level of the msg.
+        """
+        selected = set(self.topicSelectionONHeaders)
+        paths = []
+        # stack of (attribute path, value) still to be visited.
+        stack = [((), msg)]
+        while stack:
+            path, value = stack.pop()
+            if hasattr(type(value), '__slots__'):
+                for s in reversed(type(value).__slots__):
+                    if s not in ignore:
+                        stack.append((path + (s,), getattr(value, s)))
+            elif ".".join((topicName,) + path) in selected:
+                paths.append(".".join(path))
+
+        headers = tuple(topicName + "." + path for path in paths)
+        if len(paths) == 1:
+            # attrgetter returns the value itself (not a tuple) when given a single attribute.
+            single = operator.attrgetter(paths[0])
+            getter = lambda m: (single(m),)
+        elif len(paths):
+            getter = operator.attrgetter(*paths)
+        else:
+            getter = lambda m: ()
+        return headers, getter
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+# Persistent index of a bag: the time and the position (chunk and offset) of
+# the msgs of each connection, as int64 arrays, and the type (name and md5) of
+# each connection. rosbag builds its index when it opens a bag, reading the index
+# records after every chunk into a Python object per msg, which is slow and
+# memory hungry for large bags. The index is built from it the first time the
+# bag is opened and kept in the cache (see file_cache.py) as a sidecar file, so
+# the next times the bag is opened without its index (rosbag's skip_index) and
+# the arrays of the sidecar are memory-mapped instead.
+#
+# The sidecar is validated by the size and modification time of the bag, and by
+# its connections (topic and type md5). Layout of the file:
+#
+#   header size :   16 ascii digits, the size of the json header.
+#   header      :   json with the version, the bag size and modification time and,
+#                   for each connection, its id, topic, type, md5, number of msgs
+#                   and the offset of its arrays. Padded to a multiple of 8 bytes.
+#   arrays      :   for each connection, an int64 array of (3, msgs): the times
+#                   (in nsecs), chunk positions and offsets of its msgs.
+
+import os
+import json
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+VERSION = 1
+HEADER_DIGITS = 16
+
+
+class ConnectionIndex(object):
+    """The index of the msgs of a bag connection, sorted by time:
+        stamps      :   int64 array, the time of each msg in nsecs.
+        chunk_pos   :   int64 array, the position of the chunk of each msg in the bag file.
+        offsets     :   int64 array, the offset of each msg in its (uncompressed) chunk.
+    """
+
+    def __init__(self, stamps, chunk_pos, offsets):
+        self.stamps = stamps
+        self.chunk_pos = chunk_pos
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.stamps)
+
+
+def indexFromBag(bag):
+    """Returns the index of each connection (connection id -> ConnectionIndex) of a rosbag.Bag
+    opened with its index."""
+    indexes = {}
+    for c in bag._get_connections():
+        entries = bag._connection_indexes[c.id]
+        indexes[c.id] = ConnectionIndex(np.array([e.time.to_nsec() for e in entries], dtype=np.int64),
+                                        np.array([e.chunk_pos for e in entries], dtype=np.int64),
+                                        np.array([e.offset for e in entries], dtype=np.int64))
+    return indexes
+
+
+def bagStat(filename):
+    stat = os.stat(filename)
+    return stat.st_size, stat.st_mtime
+
+
+def connectionHeaders(bag):
+    """The (id, topic, type, md5) of the connections of a rosbag.Bag, which must match those
+    of the index."""
+    return sorted((c.id, c.topic, c.datatype, c.md5sum) for c in bag._get_connections())
+
+
+def writeBagIndex(path, filename, bag, indexes):
+    """Writes the index (see indexFromBag) of the bag file into path."""
+    size, mtime = bagStat(filename)
+    header = {"version": VERSION, "size": size, "mtime": mtime, "connections": []}
+    offset = 0
+    for conn_id, topic, datatype, md5sum in connectionHeaders(bag):
+        count = len(indexes[conn_id])
+        header["connections"].append({"id": conn_id, "topic": topic, "type": datatype, "md5sum": md5sum,
+                                      "count": count, "offset": offset})
+        offset += 3 * 8 * count
+    header_json = json.dumps(header)
+    start = HEADER_DIGITS + len(header_json)
+    with open(path, 'wb') as index_file:
+        index_file.write(str(len(header_json)).zfill(HEADER_DIGITS) + header_json + " " * (-start % 8))
+        for conn in header["connections"]:
+            index = indexes[conn["id"]]
+            index_file.write(np.vstack((index.stamps, index.chunk_pos, index.offsets)).astype(np.int64).tostring())
+
+
+def readBagIndex(path, filename, bag):
+    """Returns the index of the bag file kept in path, with its arrays memory-mapped, or None
+    if it does not belong to the bag as it is now (see the module comments) or cannot be read
+    (e.g. a truncated or corrupted file), so the index is built again."""
+    try:
+        with open(path, 'rb') as index_file:
+            header_size = int(index_file.read(HEADER_DIGITS))
+            header = json.loads(index_file.read(header_size))
+        if header.get("version") != VERSION or [header["size"], header["mtime"]] != list(bagStat(filename)):
+            return None
+        conns = [(c["id"], c["topic"], c["type"], c["md5sum"]) for c in header["connections"]]
+        if sorted(conns) != connectionHeaders(bag):
+            return None
+
+        start = HEADER_DIGITS + header_size
+        start += -start % 8
+        indexes = {}
+        for conn in header["connections"]:
+            if conn["count"]:
+                arrays = np.memmap(path, np.int64, 'r', start + conn["offset"], (3, conn["count"]))
+            else:
+                arrays = np.zeros((3, 0), dtype=np.int64)
+            indexes[conn["id"]] = ConnectionIndex(arrays[0], arrays[1], arrays[2])
+        return indexes
+    except (ValueError, KeyError, TypeError, AttributeError, IOError, OSError) as e:
+        logger.debug("Could not read the index " + path + ": " + str(e))
+        return None
+
+
+def indexKey(cache, filename):
+    return cache.key("index", os.path.abspath(filename))
+
+
+def loadBagIndex(cache, filename, bag):
+    """Returns the index of the bag file (a rosbag.Bag, opened with or without its index) kept in
+    the cache, or None."""
+    path = cache.lookup(indexKey(cache, filename), ".index", "index of " + filename)
+    if path is None:
+        return None
+    indexes = readBagIndex(path, filename, bag)
+    if indexes is None:
+        logger.info("The index of " + filename + " is outdated, it is built again")
+    return indexes
+
+
+def storeBagIndex(cache, filename, bag, indexes):
+    """Writes the index of the bag file into the cache."""
+    key = indexKey(cache, filename)
+    partial_file = cache.partialPath(key, ".index")
+    try:
+        writeBagIndex(partial_file, filename, bag, indexes)
+        cache.store(partial_file, key, ".index")
+    except (IOError, OSError) as e:
+        cache.discard(partial_file)
+        logger.warning("Could not write the index of " + filename + ": " + str(e))
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+# Metadata of a bag (topics, types, msg counts, duration) read directly from the
+# connections and the index of the bag (see bag_index.py). This avoids
+# bag._get_yaml_info(), which formats the whole bag info as yaml (computing the
+# frequency of every topic from all its msgs) just for parsing it back.
+#
+# The frequency of a topic is only computed when it is requested, and it is kept
+# in the cache (see file_cache.py), so reopening the bag does not compute it again.
+
+import json
+import logging
+import numpy as np
+from file_cache import bagFingerprint
+import instrumentation
+
+logger = logging.getLogger(__name__)
+
+
+class TopicInfo(dict):
+    """The info of a topic, with the keys of the topics listed by bag._get_yaml_info():
+    "topic", "type", "messages" and "frequency". The frequency is computed the first
+    time it is accessed (see BagMetadata.frequency)."""
+
+    def __init__(self, metadata, **info):
+        super(TopicInfo, self).__init__(**info)
+        self.metadata = metadata
+
+    def __missing__(self, key):
+        if key != "frequency":
+            raise KeyError(key)
+        self[key] = self.metadata.frequency(self["topic"])
+        return self[key]
+
+
+class BagMetadata(object):
+    """The metadata of an opened bag.
+        bag     :   the BagSession of the bag files (see bag_session.py).
+        cache   :   FileCache keeping the frequencies of the topics (None for not keeping them).
+    """
+
+    def __init__(self, bag, cache=None):
+        self.bag = bag
+        self.cache = cache
+        self.cache_key = None       # see cacheKey.
+
+        connections = {}    # topic -> its connections (a topic may have been recorded by several nodes)
+        for c in bag._get_connections():
+            connections.setdefault(c.topic, []).append(c)
+        self.connections = connections
+        self.topics = [TopicInfo(self, topic=topic, type=conns[0].datatype,
+                                 messages=sum(len(bag.connection_indexes[c.id]) for c in conns))
+                       for topic, conns in sorted(connections.items())]
+        self.message_count = sum(top["messages"] for top in self.topics)
+        # the bag start and end times are taken from its chunks (the bag raises if it has no msgs).
+        self.start_time = bag.get_start_time() if self.message_count else 0.0
+        self.end_time = bag.get_end_time() if self.message_count else 0.0
+        self.duration = self.end_time - self.start_time
+        self.frequencies = None     # topic -> frequency, loaded from the cache when first needed.
+
+    def topicNames(self):
+        return [top["topic"] for top in self.topics]
+
+    def topicsOfType(self, suffix):
+        """Returns the names of the topics whose type ends with suffix."""
+        return [top["topic"] for top in self.topics if top["type"].endswith(suffix)]
+
+    def frequency(self, topic):
+        """Returns the frequency of a topic (in Hz) as bag._get_yaml_info() does: the inverse
+        of the median period between its msgs. None if the topic has less than 2 msgs."""
+        if self.frequencies is None:
+            self.frequencies = self.loadFrequencies()
+        if topic not in self.frequencies:
+            with instrumentation.span("topic frequency") as span:
+                stamps = self.bag.entries([topic])[0]
+                period = np.median(np.diff(stamps)) / 1e9 if len(stamps) > 1 else 0.0
+                span.add(len(stamps))
+            self.frequencies[topic] = 1.0 / period if period > 0 else None
+            self.storeFrequencies()
+        return self.frequencies[topic]
+
+    def cacheKey(self):
+        if self.cache_key is None:
+            # the fingerprints of all the files of a bag session (see bag_session.py).
+            filenames = getattr(self.bag, "filenames", [self.bag.filename])
+            self.cache_key = self.cache.key("frequencies", *[bagFingerprint(f) for f in filenames])
+        return self.cache_key
+
+    def loadFrequencies(self):
+        """Returns the frequencies of the topics kept in the cache."""
+        if self.cache is None:
+            return {}
+        path = self.cache.lookup(self.cacheKey(), ".json", "frequencies of " + self.bag.filename)
+        if path is None:
+            return {}
+        try:
+            with open(path) as json_file:
+                return json.load(json_file)
+        except ValueError:
+            return {}
+
+    def storeFrequencies(self):
+        """Writes the frequencies of the topics computed so far into the cache."""
+        if self.cache is None:
+            return
+        key = self.cacheKey()
+        partial_file = self.cache.partialPath(key, ".json")
+        with open(partial_file, 'w') as json_file:
+            json.dump(self.frequencies, json_file)
+        self.cache.store(partial_file, key, ".json")
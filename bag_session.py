@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+# A set of bags read as a single one, e.g. the chunks written by "rosbag record
+# --split" (session_0.bag, session_1.bag, ...). The bags are not concatenated:
+# their msgs are merged by time when they are read, and the index of a topic is
+# the merge of the indexes of the bags.
+#
+# BagSession provides the part of the rosbag.Bag interface used by this project
+# (bag metadata, msg reading and connections), so it can be used in place of a
+# bag. The connections of the bags get new ids, unique in the session, and their
+# indexes are kept as arrays (see bag_index.py): given a cache, the index of each
+# bag is kept in it, so a bag opened again does not read its index records.
+
+import os
+import re
+import copy
+import logging
+import numpy as np
+import rosbag
+import instrumentation
+from bag_index import indexFromBag, loadBagIndex, storeBagIndex
+
+logger = logging.getLogger(__name__)
+
+SPLIT_PATTERN = re.compile(r"^(.*)_(\d+)\.bag$")     # the name of the chunks of a split bag.
+READ_BLOCK = 65536      # msgs positions prepared at once by readEntries.
+
+
+def splitBagFiles(filename):
+    """Returns the chunks of the split bag filename belongs to (sorted by their number), or
+    just [filename] if it is not a chunk of a split bag."""
+    match = SPLIT_PATTERN.match(filename)
+    if match is None:
+        return [filename]
+    directory = os.path.dirname(filename)
+    chunks = []
+    for name in os.listdir(directory or "."):
+        chunk = os.path.join(directory, name)
+        chunk_match = SPLIT_PATTERN.match(chunk)
+        if chunk_match and chunk_match.group(1) == match.group(1):
+            chunks.append(chunk)
+    return sortBagFiles(chunks)
+
+
+def sortBagFiles(filenames):
+    """Sorts bag file names, the chunks of a split bag by their number."""
+    def key(filename):
+        match = SPLIT_PATTERN.match(filename)
+        return (match.group(1), int(match.group(2))) if match else (filename[:-4], -1)
+    return sorted(filenames, key=key)
+
+
+def sessionName(filenames):
+    """The name of a set of bag files (without extension): the name of the split bag for its
+    chunks (e.g. "session" for session_0.bag, session_1.bag, ...), or of the first file."""
+    match = SPLIT_PATTERN.match(filenames[0])
+    name = match.group(1) if match and len(filenames) > 1 else filenames[0][:-4]
+    return os.path.basename(name)
+
+
+def nsecToSec(nsecs):
+    """Converts a time in nsecs into secs, giving the same float as rospy.Time.to_sec."""
+    return float(nsecs // 1000000000) + float(nsecs % 1000000000) / 1e9
+
+
+class BagSession(object):
+    """The bags of the given files (see sortBagFiles for their order), read as a single bag.
+        cache   :   FileCache keeping the index of the bags (None for reading it from the bags).
+        progress:   function called with the number of bags opened and the total, or None.
+    """
+
+    def __init__(self, filenames, cache=None, progress=None):
+        self.filenames = sortBagFiles(filenames)
+        self.filename = self.filenames[0]
+        self.bags = []
+        bag_indexes = []
+        try:
+            for f in self.filenames:
+                if progress is not None:
+                    progress(len(self.bags), len(self.filenames))
+                bag, indexes = self.openBag(f, cache)
+                self.bags.append(bag)
+                bag_indexes.append(indexes)
+        except:
+            self.close()
+            raise
+
+        # the connections of all the bags, with ids unique in the session.
+        self._connections = {}
+        self.connection_indexes = {}    # connection id -> its ConnectionIndex (see bag_index.py).
+        self.connection_bags = {}       # connection id -> the bag it belongs to.
+        for bag, indexes in zip(self.bags, bag_indexes):
+            for c in bag._get_connections():
+                session_connection = copy.copy(c)
+                session_connection.id = len(self._connections)
+                self._connections[session_connection.id] = session_connection
+                self.connection_indexes[session_connection.id] = indexes[c.id]
+                self.connection_bags[session_connection.id] = bag
+        if len(self.bags) > 1:
+            logger.info("Bag session of " + str(len(self.bags)) + " files: " + ", ".join(self.filenames))
+
+    def openBag(self, filename, cache):
+        """Opens a bag file, without reading its index records if its index is in the cache.
+        Returns the rosbag.Bag and its index (see bag_index.py)."""
+        if cache is not None:
+            bag = rosbag.Bag(filename, skip_index=True)
+            indexes = loadBagIndex(cache, filename, bag)
+            if indexes is not None:
+                return bag, indexes
+            bag.close()
+        with instrumentation.span("bag index"):
+            bag = rosbag.Bag(filename)
+            indexes = indexFromBag(bag)
+        if cache is not None:
+            storeBagIndex(cache, filename, bag, indexes)
+        return bag, indexes
+
+    def __len__(self):
+        return len(self.bags)
+
+    def close(self):
+        for bag in self.bags:
+            bag.close()
+
+    def get_start_time(self):
+        """Time (in secs) of the first msg of the bags, from their index."""
+        return nsecToSec(min(int(index.stamps[0]) for index in self.connection_indexes.values() if len(index)))
+
+    def get_end_time(self):
+        """Time (in secs) of the last msg of the bags, from their index."""
+        return nsecToSec(max(int(index.stamps[-1]) for index in self.connection_indexes.values() if len(index)))
+
+    def _get_connections(self, topics=None, connection_filter=None):
+        for c in self._connections.values():
+            if topics is None or c.topic in topics:
+                yield c
+
+    def entries(self, topics=None, start_time=None, end_time=None):
+        """Returns the index of the msgs of the given topics (all of them if None) in all the
+        bags, sorted by time (the msgs with the same time in the order of the bags and of their
+        connections, as rosbag reads them): the int64 arrays of their times (in nsecs),
+        connection ids, chunk positions and offsets. The [start_time, end_time] range (rospy
+        times, None for no limit) selects the msgs, as in read_messages."""
+        indexes = [(c.id, self.connection_indexes[c.id]) for c in sorted(self._get_connections(topics=topics),
+                                                                            key=lambda c: c.id)]
+        if not len(indexes):
+            return tuple(np.zeros(0, dtype=np.int64) for _ in range(4))
+        stamps = np.concatenate([index.stamps for _, index in indexes])
+        ids = np.concatenate([np.full(len(index), conn_id, dtype=np.int64) for conn_id, index in indexes])
+        chunk_pos = np.concatenate([index.chunk_pos for _, index in indexes])
+        offsets = np.concatenate([index.offsets for _, index in indexes])
+        selected = np.ones(len(stamps), dtype=bool)
+        if start_time is not None:
+            selected &= stamps >= start_time.to_nsec()
+        if end_time is not None:
+            selected &= stamps <= end_time.to_nsec()
+        if not selected.all():
+            stamps, ids, chunk_pos, offsets = stamps[selected], ids[selected], chunk_pos[selected], offsets[selected]
+        order = np.argsort(stamps, kind='mergesort')
+        return stamps[order], ids[order], chunk_pos[order], offsets[order]
+
+    def read_messages(self, topics=None, start_time=None, end_time=None):
+        """Generator of the (topic, msg, time) tuples of the msgs of all the bags, sorted by time
+        (see entries). The msgs are read at their positions in the index."""
+        _, ids, chunk_pos, offsets = self.entries(topics, start_time, end_time)
+        return self.readEntries(ids, chunk_pos, offsets)
+
+    def readRanges(self, topics, ranges):
+        """Generator of the (topic, msg, time) tuples of the msgs of the given topics in the time
+        ranges (sorted list of disjoint [start, end] in nsecs), sorted by time. The index of the
+        topics is merged once, and the msgs of each range are a slice of it."""
+        stamps, ids, chunk_pos, offsets = self.entries(topics)
+        for begin, end in ranges:
+            first = stamps.searchsorted(begin, side='left')
+            last = stamps.searchsorted(end, side='right')
+            for item in self.readEntries(ids[first:last], chunk_pos[first:last], offsets[first:last]):
+                yield item
+
+    def readEntries(self, ids, chunk_pos, offsets):
+        """Generator of the (topic, msg, time) tuples of the msgs at the given positions (see entries)."""
+        bags = self.connection_bags
+        # the positions are converted into Python ints by blocks, not all at once.
+        for block in range(0, len(ids), READ_BLOCK):
+            block_ids = ids[block:block + READ_BLOCK].tolist()
+            positions = zip(chunk_pos[block:block + READ_BLOCK].tolist(), offsets[block:block + READ_BLOCK].tolist())
+            for conn_id, position in zip(block_ids, positions):
+                bag_message = bags[conn_id]._read_message(position)
+                yield bag_message.topic, bag_message.message, bag_message.timestamp
+
+    def topicIndex(self, topic):
+        """Returns the times (int64 numpy array, in nsecs) and the positions (list of
+        (connection id, chunk_pos, offset) tuples, see readMessage) of the msgs of a topic in
+        all the bags, sorted by time. Only the bag indexes are read, no msg is deserialized."""
+        with instrumentation.span("topic index") as span:
+            stamps, ids, chunk_pos, offsets = self.entries([topic])
+            span.add(len(stamps))
+            return stamps, zip(ids.tolist(), chunk_pos.tolist(), offsets.tolist())
+
+    def topicStartTime(self, topic):
+        """Returns the time (in nsecs) of the first msg of a topic, or None if it has no msgs."""
+        starts = [int(self.connection_indexes[c.id].stamps[0]) for c in self._get_connections(topics=[topic])
+                  if len(self.connection_indexes[c.id])]
+        return min(starts) if len(starts) else None
+
+    def messageCount(self, topic):
+        """Returns the number of msgs of a topic in all the bags."""
+        return sum(len(self.connection_indexes[c.id]) for c in self._get_connections(topics=[topic]))
+
+    def readMessage(self, position):
+        """Reads the msg at a position given by topicIndex."""
+        connection_id, chunk_pos, offset = position
+        with instrumentation.span("bag read", items=1):
+            return self.connection_bags[connection_id]._read_message((chunk_pos, offset)).message
+
+    def bagSize(self):
+        """Total size (in bytes) of the files of the session."""
+        return sum(os.path.getsize(f) for f in self.filenames)
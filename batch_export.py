@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Headless counterpart of the "annotation_parser.py" program. It exports a batch
+# of bag/annotation pairs into csv files (the same ones the "Export CSV" button
+# generates), using a pool of processes that handle one bag each. It does not
+# need a display, so it can run on servers.
+#
+# The jobs are described in a json manifest, a list of objects like:
+#
+#   [
+#       {
+#           "bag": "session_01.bag",
+#           "annotation": "session_01.json",
+#           "topics": ["/imu/data.linear_acceleration", "/odom.twist.twist.linear.x"],
+#           "output": "csv/session_01.csv"
+#       }
+#   ]
+#
+# "topics" lists the selected items of the tree of topics: a topic name (or an
+# attribute in the middle of the tree) selects all the attributes below it.
+# "output" is optional and defaults to the bag file name. Relative paths are
+# taken from the directory of the manifest. A job can also set the output
+# "format" ("csv" or "npy", see export_writers.py) and "streaming" (true for the
+# low memory export, false by default as in the annotation parser). "bag" can
+# also be a list with the chunks of a split bag, which are exported as a single
+# bag (see bag_session.py).
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import traceback
+import multiprocessing
+from bag_session import BagSession, sessionName
+from file_cache import FileCache
+from bag_export import BagExporter, expandTopicSelection
+from export_writers import FORMATS
+
+logger = logging.getLogger("batch_export")
+
+
+def loadManifest(filename):
+    """Loads the manifest, resolving the relative paths of its jobs."""
+    with open(filename) as json_file:
+        jobs = json.load(json_file)
+    basedir = os.path.dirname(os.path.abspath(filename))
+    for job in jobs:
+        if not isinstance(job["bag"], list):
+            job["bag"] = [job["bag"]]
+        job["bag"] = [os.path.join(basedir, f) for f in job["bag"]]
+        for k in ("annotation", "output"):
+            if k in job:
+                job[k] = os.path.join(basedir, job[k])
+        if "output" not in job:
+            job["output"] = os.path.join(os.path.dirname(job["bag"][0]), sessionName(job["bag"]) + ".csv")
+    return jobs
+
+
+def runJob(job):
+    """Exports one bag/annotation pair. It runs in a worker process and returns a
+    dictionary describing the result of the job (never raises)."""
+    result = {"bag": ", ".join(job["bag"]), "files": [], "msgs": 0, "rows": 0, "bytes": 0, "secs": 0.0, "error": None}
+    start = time.time()
+    try:
+        with open(job["annotation"]) as json_file:
+            annotation = json.load(json_file)
+        headers = expandTopicSelection(annotation["topics"], job["topics"])
+
+        # the index of the bags is kept in the cache (see bag_index.py).
+        bag = BagSession(job["bag"], FileCache())
+        try:
+            # same check of the annotation parser: the bag must have the annotated topics.
+            bag_topics = set(c.topic for c in bag._get_connections())
+            missing = [t for t in annotation["topics"].keys() if t not in bag_topics]
+            if len(missing):
+                raise ValueError("bag is incompatible with the annotation file. Missing topics: " +
+                                 ", ".join(missing))
+
+            exporter = BagExporter(bag, annotation, headers, job.get("tolerance", 0.02))
+            result["files"] = exporter.export(job["output"], job.get("streaming", False), job.get("format", "csv"))
+            result["msgs"] = exporter.msg_count
+            result["rows"] = exporter.row_count
+        finally:
+            bag.close()
+        result["bytes"] = bag.bagSize()
+    except Exception:
+        result["error"] = traceback.format_exc()
+    result["secs"] = time.time() - start
+    return result
+
+
+def describe(result):
+    """Returns the throughput line of a job result."""
+    secs = max(result["secs"], 1e-9)
+    return ("%s: %d msgs, %d rows in %.2fs (%.0f msgs/s, %.1f MB/s)" %
+            (result["bag"], result["msgs"], result["rows"], result["secs"],
+             result["msgs"] / secs, result["bytes"] / secs / 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Exports a batch of annotated bags into csv files.")
+    parser.add_argument("manifest", help="json file listing the jobs (bag, annotation, topics, output)")
+    parser.add_argument("-j", "--jobs", type=int, default=multiprocessing.cpu_count(),
+                        help="number of worker processes (default: number of cpus)")
+    parser.add_argument("--streaming", action="store_true",
+                        help="streams the selected topics of each bag instead of loading them in memory "
+                             "(the \"Low memory export\" of the annotation parser)")
+    parser.add_argument("--format", choices=FORMATS, default=None,
+                        help="output format: csv files or directories of .npy columns (default: csv)")
+    parser.add_argument("--tolerance", type=float, default=None,
+                        help="mismatch tolerance of the windows endpoints (default: 0.02)")
+    parser.add_argument("-v", "--verbose", action="store_true", help="prints the export log of each window")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING,
+                        format='%(asctime)s -- %(levelname)s --> %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+
+    jobs = loadManifest(args.manifest)
+    for job in jobs:
+        if args.streaming:
+            job["streaming"] = True
+        if args.tolerance is not None:
+            job["tolerance"] = args.tolerance
+        if args.format is not None:
+            job["format"] = args.format
+
+    start = time.time()
+    failed = []
+    total = {"msgs": 0, "rows": 0, "bytes": 0}
+    # maxtasksperchild=1: each bag is exported by a fresh process, so that the memory
+    # of a large bag is given back before the next one.
+    pool = multiprocessing.Pool(processes=max(1, min(args.jobs, len(jobs))), maxtasksperchild=1)
+    try:
+        for n, result in enumerate(pool.imap_unordered(runJob, jobs)):
+            if result["error"]:
+                failed.append(result)
+                sys.stdout.write("[%d/%d] FAILED %s\n%s" % (n + 1, len(jobs), result["bag"], result["error"]))
+            else:
+                for k in total.keys():
+                    total[k] += result[k]
+                sys.stdout.write("[%d/%d] %s\n" % (n + 1, len(jobs), describe(result)))
+            sys.stdout.flush()
+        pool.close()
+    except:
+        # e.g. KeyboardInterrupt. The pool must be closed or terminated before join, which
+        # otherwise fails and hides the error.
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    elapsed = max(time.time() - start, 1e-9)
+    sys.stdout.write("\nSUMMARY: %d jobs, %d exported, %d failed in %.2fs\n" %
+                     (len(jobs), len(jobs) - len(failed), len(failed), elapsed))
+    sys.stdout.write("\t%d msgs, %d rows (%.0f msgs/s, %.1f MB/s)\n" %
+                     (total["msgs"], total["rows"], total["msgs"] / elapsed, total["bytes"] / elapsed / 1e6))
+    for result in failed:
+        sys.stdout.write("\tFAILED: %s\n" % result["bag"])
+    return 1 if len(failed) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Benchmarks of the hot paths of the annotator and of the data export, on a
+# synthetic bag (see synthetic_bag.py) or on a given bag and annotation json:
+#
+#   python benchmarks/run_benchmarks.py --workdir /tmp/bench --duration 120 --output after.json
+#   python benchmarks/run_benchmarks.py --bag session.bag --annotation session.json
+#
+# Each benchmark runs in its own process, so its peak RSS (resident memory) is
+# measured independently of the others. The results are written as json: the
+# parameters and, for each benchmark, its time, the msgs (or frames) and bytes
+# it processed, their throughput and the peak RSS. Passing the results of a
+# previous run with --compare prints the speedup of each benchmark.
+#
+# The GUI methods are not called (they need a display), but the same work they
+# do: e.g. "buffer_data" indexes the image topic and builds the tree of topics
+# as VideoPlayer.buffer_data does.
+
+import os
+import sys
+import json
+import time
+import shutil
+import filecmp
+import logging
+import argparse
+import platform
+import resource
+import tempfile
+import multiprocessing
+import cv2
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from annotator_utils import get_bag_metadata
+from bag_export import BagExporter, expandTopicSelection
+from bag_metadata import BagMetadata
+from bag_session import BagSession
+from frame_source import FrameSource, parallelDecode, DEFAULT_DECODE_THREADS
+from topic_schema import SchemaRegistry
+import synthetic_bag
+
+logger = logging.getLogger("run_benchmarks")
+
+
+class Benchmark(object):
+    """The bag and annotation a benchmark runs on. The benchmarks (the methods named by
+    BENCHMARKS) return a dictionary with the number of "msgs" and of "bytes" they processed,
+    and optionally the "rows" and "bytes_written" they wrote and the "secs" of the part of
+    their work that is timed (by default, all of it)."""
+
+    def __init__(self, filenames, annotation_file, workdir):
+        self.filenames = filenames
+        self.workdir = workdir
+        with open(annotation_file) as json_file:
+            self.annotation = json.load(json_file)
+        self.bag = BagSession(filenames)
+        self.bag_bytes = self.bag.bagSize()
+        self.image_topic = self.annotation["used_image_topic"]
+        # all the attributes of all the topics of the annotation are exported.
+        self.headers = expandTopicSelection(self.annotation["topics"], self.annotation["topics"].keys())
+
+    def close(self):
+        self.bag.close()
+
+    def open(self):
+        """Opens the bag files and reads their metadata from the index."""
+        self.bag.close()
+        self.bag = BagSession(self.filenames)
+        return {"msgs": BagMetadata(self.bag).message_count, "bytes": self.bag_bytes}
+
+    def get_bag_metadata(self):
+        """annotator_utils.get_bag_metadata, plus the frequency of every topic (as the bag info shows
+        them), which are reported with the result."""
+        message_count, duration, topics, _, _, _ = get_bag_metadata(self.bag)
+        return {"msgs": sum(top["messages"] for top in topics), "bytes": self.bag_bytes,
+                "frequencies": dict((top["topic"], top["frequency"]) for top in topics)}
+
+    def bufferData(self):
+        """Indexes the image topic and builds the tree of the other topics."""
+        frame_source = FrameSource(self.bag, self.image_topic)
+        topics = [t for t in BagMetadata(self.bag).topicNames() if t != self.image_topic]
+        SchemaRegistry().topicTrees(self.bag, topics)
+        return {"msgs": len(frame_source), "bytes": 0}
+
+    def buffer_data(self):
+        """The work of VideoPlayer.buffer_data."""
+        return self.bufferData()
+
+    def load_image_topic(self):
+        """The work of VideoPlayer.loadImageTopic: buffer_data and the index of the topics of the tree."""
+        frames = self.bufferData()["msgs"]
+        msgs = sum(len(self.bag.entries([topic])[0]) for topic in self.annotation["topics"].keys())
+        return {"msgs": frames + msgs, "bytes": 0}
+
+    def decode(self, **options):
+        """Decodes all the frames of the image topic (see FrameSource.frames)."""
+        frame_source = FrameSource(self.bag, self.image_topic, **options)
+        read = [0]
+
+        def messages():
+            for i in range(len(frame_source)):
+                msg = frame_source.readMessage(i)
+                read[0] += len(msg.data)
+                yield msg
+        frames = sum(1 for _ in parallelDecode(frame_source.decode, messages(), frame_source.threads))
+        return {"msgs": frames, "bytes": read[0]}
+
+    def decode_proxy(self):
+        """Decodes the frames as the annotator plays them (proxy resolution, BGRA)."""
+        return self.decode(conversion=cv2.COLOR_BGR2BGRA)
+
+    def decode_full(self):
+        """Decodes the frames at their full resolution."""
+        return self.decode(proxy_height=0)
+
+    def exporter(self):
+        return BagExporter(self.bag, self.annotation, self.headers)
+
+    def load_bag_data(self):
+        """BagExporter.loadBagData (the data loading of the annotation parser)."""
+        exporter = self.exporter()
+        exporter.loadBagData()
+        return {"msgs": exporter.msg_count, "bytes": self.bag_bytes}
+
+    def write_data(self):
+        """BagExporter.writeData into csv files (the data is loaded before the timing starts)."""
+        exporter = self.exporter()
+        exporter.loadBagData()
+        exporter.openOutputFiles(os.path.join(self.workdir, "write_data"))
+        start = time.time()
+        try:
+            exporter.writeData()
+        finally:
+            exporter.closeOutputFiles()
+        return {"msgs": exporter.msg_count, "bytes": 0, "rows": exporter.row_count, "secs": time.time() - start}
+
+    def export(self, streaming, format):
+        exporter = self.exporter()
+        filenames = exporter.export(os.path.join(self.workdir, "export"), streaming, format)
+        return {"msgs": exporter.msg_count, "bytes": self.bag_bytes, "rows": exporter.row_count,
+                "bytes_written": sum(outputSize(f) for f in filenames)}
+
+    def export_csv(self):
+        """Full export into csv files, loading the data in memory."""
+        return self.export(False, "csv")
+
+    def export_csv_streaming(self):
+        """Full export into csv files, streaming the data from the bag."""
+        return self.export(True, "csv")
+
+    def export_npy(self):
+        """Full export into numpy column directories, streaming the data from the bag."""
+        return self.export(True, "npy")
+
+    def ranged_export_check(self):
+        """Exports the csv files reading only the ranges of the tagged windows and reading all
+        the msgs (see BagExporter.export), loading and streaming the data, and fails if the files
+        differ. The time is that of the ranged exports."""
+        counts = {"msgs": 0, "bytes": 0, "rows": 0, "secs": 0.0}
+        for streaming in (False, True):
+            start = time.time()
+            exporter = self.exporter()
+            ranged_files = exporter.export(os.path.join(self.workdir, "ranged"), streaming, "csv")
+            counts["secs"] += time.time() - start
+            counts["msgs"] += exporter.msg_count
+            counts["bytes"] += self.bag_bytes
+            counts["rows"] += exporter.row_count
+            full_files = self.exporter().export(os.path.join(self.workdir, "unranged"), streaming, "csv", ranged=False)
+            for ranged_file, full_file in zip(ranged_files, full_files):
+                if not filecmp.cmp(ranged_file, full_file, shallow=False):
+                    raise AssertionError(os.path.basename(ranged_file) + " differs from the export of all the msgs" +
+                                         (" (streaming)" if streaming else ""))
+        return counts
+
+
+BENCHMARKS = ["open", "get_bag_metadata", "buffer_data", "load_image_topic", "decode_proxy", "decode_full",
+              "load_bag_data", "write_data", "export_csv", "export_csv_streaming", "export_npy", "ranged_export_check"]
+
+
+def outputSize(path):
+    """Size (in bytes) of an output file, or of the files of an output directory."""
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+    return os.path.getsize(path)
+
+
+def peakRssMB():
+    # ru_maxrss is in KB on linux (and in bytes on mac).
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024.0 * 1024.0) if platform.system() == "Darwin" else rss / 1024.0
+
+
+def runBenchmark(name, filenames, annotation_file, workdir, queue):
+    """Runs a benchmark in a child process, putting its result in the queue."""
+    result = {"name": name, "error": None}
+    try:
+        benchmark = Benchmark(filenames, annotation_file, workdir)
+        result["rss_start_mb"] = peakRssMB()
+        start = time.time()
+        counts = getattr(benchmark, name)()
+        secs = counts.pop("secs", time.time() - start)
+        benchmark.close()
+        result.update(counts)
+        result.update({"secs": secs, "msgs_per_sec": counts["msgs"] / max(secs, 1e-9),
+                       "mb_per_sec": counts["bytes"] / max(secs, 1e-9) / 1e6, "peak_rss_mb": peakRssMB()})
+    except Exception as e:
+        logger.exception(name)
+        result["error"] = str(e)
+    queue.put(result)
+
+
+def run(names, filenames, annotation_file, workdir, repeat=1):
+    """Runs the benchmarks, each one repeat times (in a new process each time). Returns the
+    results: those of the fastest run of each benchmark, with the times of all its runs."""
+    results = []
+    for name in names:
+        runs = []
+        for _ in range(repeat):
+            queue = multiprocessing.Queue()
+            process = multiprocessing.Process(target=runBenchmark,
+                                              args=(name, filenames, annotation_file, workdir, queue))
+            process.start()
+            runs.append(queue.get())
+            process.join()
+        valid = [r for r in runs if r["error"] is None]
+        result = min(valid, key=lambda r: r["secs"]) if len(valid) else runs[0]
+        result["runs"] = [r.get("secs") for r in runs]
+        results.append(result)
+        describe(result)
+    return results
+
+
+def describe(result):
+    """Prints the summary line of a result to stderr."""
+    if result["error"] is not None:
+        sys.stderr.write("%-22s FAILED: %s\n" % (result["name"], result["error"]))
+        return
+    sys.stderr.write("%-22s %8.3fs %10.0f msgs/s %8.1f MB/s %8.1f MB peak RSS\n" %
+                     (result["name"], result["secs"], result["msgs_per_sec"], result["mb_per_sec"],
+                      result["peak_rss_mb"]))
+
+
+def compare(results, previous_file):
+    """Prints the speedup and the peak RSS change of each benchmark over a previous run."""
+    with open(previous_file) as json_file:
+        previous = dict((r["name"], r) for r in json.load(json_file)["results"] if r.get("error") is None)
+    sys.stderr.write("\nCompared with " + previous_file + ":\n")
+    for result in results:
+        before = previous.get(result["name"])
+        if before is None or result["error"] is not None:
+            continue
+        sys.stderr.write("%-22s %6.2fx faster %+8.1f MB peak RSS\n" %
+                         (result["name"], before["secs"] / max(result["secs"], 1e-9),
+                          result["peak_rss_mb"] - before["peak_rss_mb"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the bag loading, frame decoding and data export.")
+    parser.add_argument("--bag", nargs="+", help="bag file(s) to benchmark, instead of a synthetic one")
+    parser.add_argument("--annotation", help="annotation json of the given bag")
+    parser.add_argument("--workdir", help="directory of the synthetic bag and of the exported files "
+                                          "(default: a temporary directory, removed at the end)")
+    parser.add_argument("--config", default=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                                         "config.json"),
+                        help="config.json with the sources and labels of the synthetic annotation")
+    parser.add_argument("--only", help="comma separated benchmarks to run (default: all). One of: " +
+                                       ", ".join(BENCHMARKS))
+    parser.add_argument("--repeat", type=int, default=1, help="runs of each benchmark, the fastest is kept (default: 1)")
+    parser.add_argument("--output", help="json file for the results (default: stdout)")
+    parser.add_argument("--compare", help="results of a previous run, for printing the speedups")
+    synthetic_bag.parseArguments(parser)
+    options = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s -- %(levelname)s --> %(message)s')
+    names = options.only.split(",") if options.only else BENCHMARKS
+    for name in names:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark '" + name + "'")
+    if options.bag and not options.annotation:
+        parser.error("--bag needs its --annotation")
+
+    workdir = options.workdir or tempfile.mkdtemp(prefix="rosbag_annotator_bench_")
+    try:
+        if options.bag:
+            filenames, annotation_file = options.bag, options.annotation
+        else:
+            start = time.time()
+            filenames, annotation_file = synthetic_bag.generate(os.path.join(workdir, "synthetic.bag"),
+                                                                options, options.config)
+            sys.stderr.write("Synthetic bag written in %.1fs: %s\n" % (time.time() - start, ", ".join(filenames)))
+        results = run(names, filenames, annotation_file, workdir, options.repeat)
+        report = {"params": vars(options), "bags": filenames, "bag_bytes": sum(os.path.getsize(f) for f in filenames),
+                  "python": platform.python_version(), "cpus": multiprocessing.cpu_count(),
+                  "decode_threads": DEFAULT_DECODE_THREADS, "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                  "results": results}
+        if options.output:
+            with open(options.output, 'w') as json_file:
+                json.dump(report, json_file, indent=4, sort_keys=True)
+        else:
+            print(json.dumps(report, indent=4, sort_keys=True))
+        if options.compare:
+            compare(results, options.compare)
+    finally:
+        if not options.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Writes synthetic bags (and their annotation json) for the benchmarks, see
+# run_benchmarks.py. A bag has a sensor_msgs/CompressedImage topic (jpeg frames
+# of a moving noisy pattern, so their compression is realistic), IMU topics
+# (sensor_msgs/Imu) and odometry topics (nav_msgs/Odometry, a deeply nested
+# type), each one at its own rate. For instance:
+#
+#   python benchmarks/synthetic_bag.py /tmp/bench/session.bag --duration 120 --width 1920 --height 1080
+#
+# writes /tmp/bench/session.bag and /tmp/bench/session.json, the annotation of
+# its windows with the sources and labels of config.json, as the annotator saves it.
+
+import os
+import sys
+import json
+import random
+import argparse
+import cv2
+import numpy as np
+import rospy
+import rosbag
+from sensor_msgs.msg import CompressedImage, Imu
+from nav_msgs.msg import Odometry
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bag_session import BagSession, sessionName
+from topic_schema import SchemaRegistry
+
+IMAGE_TOPIC = "/camera/image_raw/compressed"
+START_SECS = 1500000000         # time of the first msg of the bags.
+
+
+def parseArguments(parser):
+    """Adds the options of the synthetic bags to an argparse parser."""
+    parser.add_argument("--duration", type=float, default=60.0, help="duration of the bag, in secs (default: 60)")
+    parser.add_argument("--width", type=int, default=1280, help="width of the frames (default: 1280)")
+    parser.add_argument("--height", type=int, default=720, help="height of the frames (default: 720)")
+    parser.add_argument("--fps", type=float, default=30.0, help="frame rate of the image topic (default: 30)")
+    parser.add_argument("--jpeg-quality", type=int, default=90, help="jpeg quality of the frames (default: 90)")
+    parser.add_argument("--imu-topics", type=int, default=2, help="number of IMU topics (default: 2)")
+    parser.add_argument("--imu-rate", type=float, default=100.0, help="rate of the IMU topics, in Hz (default: 100)")
+    parser.add_argument("--odom-topics", type=int, default=1, help="number of odometry topics (default: 1)")
+    parser.add_argument("--odom-rate", type=float, default=50.0, help="rate of the odometry topics, in Hz (default: 50)")
+    parser.add_argument("--chunks", type=int, default=1,
+                        help="number of files the bag is split into, as rosbag record --split does (default: 1)")
+    parser.add_argument("--win-size", type=float, default=2.0, help="size of the windows, in secs (default: 2)")
+    parser.add_argument("--overlap", type=int, default=50, help="overlap of the windows, in %% (default: 50)")
+    parser.add_argument("--tagged", type=float, default=0.8, help="fraction of the windows tagged (default: 0.8)")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the random data (default: 0)")
+    return parser
+
+
+def topicRates(options):
+    """Returns the (topic, rate) list of the data topics of the bag."""
+    return ([("/imu_%d/data" % i, options.imu_rate) for i in range(options.imu_topics)] +
+            [("/odom_%d" % i, options.odom_rate) for i in range(options.odom_topics)])
+
+
+def framePatterns(width, height, rng, count=4):
+    """Returns a few noisy patterns, twice the frame width, that are scrolled to make the frames."""
+    x = np.linspace(0, 8 * np.pi, 2 * width)
+    y = np.linspace(0, 4 * np.pi, height)
+    base = (127 + 60 * np.sin(x)[None, :] + 60 * np.cos(y)[:, None]).astype(np.float32)
+    patterns = []
+    for c in range(count):
+        noise = rng.normal(0, 12, (height, 2 * width, 3)).astype(np.float32)
+        pattern = np.dstack([base, np.roll(base, 40 * (c + 1), axis=1), base[::-1]]) + noise
+        patterns.append(np.clip(pattern, 0, 255).astype(np.uint8))
+    return patterns
+
+
+def imageMessage(stamp, frame, quality):
+    msg = CompressedImage()
+    msg.header.stamp = stamp
+    msg.header.frame_id = "camera"
+    msg.format = "jpeg"
+    msg.data = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tostring()
+    return msg
+
+
+def imuMessage(stamp, secs, phase, rng):
+    msg = Imu()
+    msg.header.stamp = stamp
+    msg.header.frame_id = "imu"
+    msg.orientation.w = 1.0
+    msg.angular_velocity.x, msg.angular_velocity.y, msg.angular_velocity.z = np.sin(secs + phase + np.arange(3)) + \
+        rng.normal(0, 0.05, 3)
+    msg.linear_acceleration.x, msg.linear_acceleration.y = rng.normal(0, 0.5, 2)
+    msg.linear_acceleration.z = 9.81 + rng.normal(0, 0.5)
+    return msg
+
+
+def odometryMessage(stamp, secs, phase, rng):
+    msg = Odometry()
+    msg.header.stamp = stamp
+    msg.header.frame_id = "odom"
+    msg.child_frame_id = "base_link"
+    msg.pose.pose.position.x = np.cos(0.1 * secs + phase) * 10
+    msg.pose.pose.position.y = np.sin(0.1 * secs + phase) * 10
+    msg.pose.pose.orientation.w = 1.0
+    msg.twist.twist.linear.x = 1.0 + rng.normal(0, 0.1)
+    msg.twist.twist.angular.z = 0.1 + rng.normal(0, 0.01)
+    return msg
+
+
+def bagFileNames(filename, chunks):
+    """The files of the bag: filename, or its chunks named as rosbag record --split does."""
+    if chunks <= 1:
+        return [filename]
+    return [filename[:-4] + "_%d.bag" % i for i in range(chunks)]
+
+
+def writeBag(filename, options):
+    """Writes the synthetic bag (split into options.chunks files). Returns the list of files."""
+    rng = np.random.RandomState(options.seed)
+    filenames = bagFileNames(filename, options.chunks)
+    directory = os.path.dirname(os.path.abspath(filename))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    # the msgs of all the topics, sorted by time: (nsecs, topic).
+    events = []
+    for topic, rate in [(IMAGE_TOPIC, options.fps)] + topicRates(options):
+        events += [(int(round(k * 1e9 / rate)), topic) for k in range(int(options.duration * rate))]
+    events.sort()
+
+    patterns = framePatterns(options.width, options.height, rng)
+    chunk_ns = int(options.duration * 1e9 / len(filenames)) + 1
+    bags = [rosbag.Bag(f, 'w') for f in filenames]
+    try:
+        frame_count = 0
+        for ns, topic in events:
+            stamp = rospy.Time(START_SECS) + rospy.Duration(0, ns)
+            secs = ns / 1e9
+            phase = hash(topic) % 7
+            if topic == IMAGE_TOPIC:
+                offset = (frame_count * 8) % options.width
+                frame = patterns[frame_count % len(patterns)][:, offset:offset + options.width]
+                msg = imageMessage(stamp, np.ascontiguousarray(frame), options.jpeg_quality)
+                frame_count += 1
+            elif topic.startswith("/imu"):
+                msg = imuMessage(stamp, secs, phase, rng)
+            else:
+                msg = odometryMessage(stamp, secs, phase, rng)
+            bags[min(ns // chunk_ns, len(bags) - 1)].write(topic, msg, stamp)
+    finally:
+        for bag in bags:
+            bag.close()
+    return filenames
+
+
+def loadLabels(config_file):
+    """Returns the sources and their labels (with their values) of a config.json."""
+    with open(config_file) as json_file:
+        return json.load(json_file)
+
+
+def writeAnnotation(filenames, options, config_file, output):
+    """Writes the annotation json of the bag, as the annotator saves it: its windows (see
+    VideoPlayer.process_windows), the tree of topics and the tags of the sources of config_file."""
+    rng = random.Random(options.seed)
+    bag = BagSession(filenames)
+    try:
+        stamps = bag.topicIndex(IMAGE_TOPIC)[0]
+        topics = [topic for topic, _ in topicRates(options)]
+        tree = SchemaRegistry().topicTrees(bag, topics)
+        duration = bag.get_end_time() - bag.get_start_time()
+    finally:
+        bag.close()
+
+    phase = options.win_size * options.overlap / 100.0 if options.overlap else options.win_size
+    phase_ns = int(round(phase * 1e9))
+    size_ns = int(round(options.win_size * 1e9))
+    begins_ns = np.arange(0, max(int(stamps[-1] - stamps[0]) - size_ns, 0), phase_ns, dtype=np.int64)
+    windows = (np.column_stack((begins_ns, begins_ns + size_ns)) / 1e9).tolist()
+
+    labels = loadLabels(config_file)
+    tagged = [rng.random() < options.tagged for _ in windows]
+    data = {"sources": sorted(labels.keys()), "win_size": options.win_size, "overlap": options.overlap,
+            "number_windows": len(windows), "duration": duration, "used_image_topic": IMAGE_TOPIC,
+            "windows_interval": windows, "topics": tree, "bags": [os.path.basename(f) for f in filenames]}
+    for source in data["sources"]:
+        data[source] = {"labels": sorted(labels[source].keys()),
+                        "tags": [dict((l, rng.choice(v)) for l, v in labels[source].items()) if tagged[w] else []
+                                 for w in range(len(windows))]}
+    with open(output, 'w') as json_file:
+        json.dump(data, json_file, indent=4, sort_keys=True)
+    return output
+
+
+def generate(filename, options, config_file):
+    """Writes the bag and its annotation json (named as the bag). Returns their file names."""
+    filenames = writeBag(filename, options)
+    annotation = os.path.join(os.path.dirname(os.path.abspath(filename)), sessionName(filenames) + ".json")
+    return filenames, writeAnnotation(filenames, options, config_file, annotation)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Writes a synthetic bag and its annotation json.")
+    parser.add_argument("bag", help="name of the bag file to write")
+    parser.add_argument("--config", default=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                                         "config.json"),
+                        help="config.json with the sources and labels of the annotation (default: the project one)")
+    options = parseArguments(parser).parse_args()
+    filenames, annotation = generate(options.bag, options, options.config)
+    print("\n".join(filenames + [annotation]))
+
+
+if __name__ == '__main__':
+    main()
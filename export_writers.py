@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+# Output formats of the data export (see bag_export.py). Each writer receives the
+# rows of the windows of one feature perspective (source), window by window:
+#
+#   - CsvWindowWriter: a csv file, with an empty line marking the end of each window.
+#
+#   - ColumnarWindowWriter: a directory with one numpy (.npy) file per column, plus
+#     the "window" column (the window of each row) and a window offset table, so
+#     a window is a slice of the columns. The files can be memory mapped (see
+#     loadColumns), that is, reading a window does not copy nor parse anything:
+#
+#       columns, windows = loadColumns("session_01_Human.columns")
+#       start, end = windows[12]
+#       x = columns["/imu/data.linear_acceleration.x"][start:end]
+#
+#     The numeric columns are stored as int64 or float64 (missing values are NaN),
+#     and the other ones (e.g. the tags) as fixed-width unicode strings.
+#     While the export runs, the values written are kept in a spill file of the
+#     directory, and the .npy files are written from it when the writer is closed.
+
+import os
+import csv
+import json
+import numbers
+import numpy as np
+
+FORMATS = ("csv", "npy")        # see createWriter.
+COLUMNS_FILE = "columns.json"   # the columns of a ColumnarWindowWriter directory and their files.
+WINDOWS_FILE = "windows.npy"    # the window offset table of a ColumnarWindowWriter directory.
+SPILL_FILE = "chunks.spill"     # the chunks of the columns of a ColumnarWindowWriter, until it is closed.
+
+
+def createWriter(format, filename, columns):
+    """Creates the writer of the given format. filename is the output name without extension.
+    Returns the writer and the name of the file (or directory) it writes."""
+    if format == "csv":
+        return CsvWindowWriter(filename + ".csv", columns), filename + ".csv"
+    elif format == "npy":
+        return ColumnarWindowWriter(filename + ".columns", columns), filename + ".columns"
+    raise ValueError("unknown export format '" + str(format) + "', must be one of: " + ", ".join(FORMATS))
+
+
+class CsvWindowWriter(object):
+    """Writes the rows (dictionaries) of the windows into a csv file with the given columns."""
+
+    def __init__(self, filename, columns):
+        self.csv_file = open(filename, 'w')
+        self.csv_writer = csv.DictWriter(self.csv_file, columns)
+        self.csv_writer.writeheader()
+        self.csv_file.flush()
+
+    def writeWindow(self, window, rows):
+        self.csv_writer.writerows(rows)         #write content to the file
+        self.csv_writer.writerows([{}])         #write an empty line to mark the end of the windows
+        self.csv_file.flush()
+
+    def close(self):
+        self.csv_file.close()
+
+
+class ColumnarWindowWriter(object):
+    """Writes the rows (dictionaries) of the windows into a directory of .npy files, one per
+    column. The values of each window are converted into typed arrays (chunks) as it is
+    written, and the chunks are appended to a spill file, so the rows are not kept in memory.
+    close writes the file of each column from its chunks, once its type is known (see
+    columnType), and removes the spill file."""
+
+    def __init__(self, directory, columns):
+        self.directory = directory
+        self.columns = list(columns)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.spill = open(os.path.join(directory, SPILL_FILE), 'w+b')
+        # column -> its chunks in the spill file: (offset, dtype, length) of each array, or the
+        # number of values of the chunks with no values (see toArray).
+        self.chunks = dict((c, []) for c in self.columns)
+        self.window_ids = []                                    # the "window" column chunks.
+        self.windows = []                                       # [start, end) rows of each window.
+        self.row_count = 0
+
+    def writeWindow(self, window, rows):
+        # the windows not written (if any) have no rows.
+        while len(self.windows) < window:
+            self.windows.append((self.row_count, self.row_count))
+        self.windows.append((self.row_count, self.row_count + len(rows)))
+        if len(rows):
+            for c in self.columns:
+                self.chunks[c].append(self.spillChunk(toArray([row.get(c) for row in rows])))
+            self.window_ids.append(self.spillChunk(np.full(len(rows), window, dtype=np.int32)))
+        self.row_count += len(rows)
+
+    def spillChunk(self, chunk):
+        """Appends the chunk (if it is an array) to the spill file. Returns its entry in chunks."""
+        if not isinstance(chunk, np.ndarray):
+            return chunk
+        self.spill.seek(0, os.SEEK_END)
+        offset = self.spill.tell()
+        self.spill.write(chunk.tostring())
+        return (offset, chunk.dtype, len(chunk))
+
+    def readChunk(self, chunk):
+        (offset, dtype, length) = chunk
+        self.spill.seek(offset)
+        return np.fromfile(self.spill, dtype, length)
+
+    def columnType(self, chunks):
+        """The type of a column given its chunks, as concatenating them would give: strings if
+        any chunk has strings, int64 if they all are integers and float64 otherwise."""
+        arrays = [c for c in chunks if not isinstance(c, numbers.Integral)]
+        if any(dtype.kind == 'U' for offset, dtype, length in arrays):
+            # the numbers of a string column are converted into strings, which may be wider.
+            width = max(c[1].itemsize // np.dtype((unicode, 1)).itemsize if c[1].kind == 'U' else
+                        np.char.str_len(self.readChunk(c).astype(unicode)).max() for c in arrays)
+            return np.dtype((unicode, max(width, 1)))
+        if len(arrays) and len(arrays) == len(chunks) and all(dtype.kind == 'i' for offset, dtype, length in arrays):
+            return np.dtype(np.int64)
+        return np.dtype(np.float64)
+
+    def writeColumn(self, filename, chunks, dtype=None):
+        """Writes the .npy file of a column from its chunks, one at a time."""
+        dtype = dtype or self.columnType(chunks)
+        count = sum(c if isinstance(c, numbers.Integral) else c[2] for c in chunks)
+        with open(os.path.join(self.directory, filename), 'wb') as npy_file:
+            np.lib.format.write_array_header_1_0(npy_file, {"descr": np.lib.format.dtype_to_descr(dtype),
+                                                            "fortran_order": False, "shape": (count,)})
+            for c in chunks:
+                if isinstance(c, numbers.Integral):
+                    values = np.full(c, u'' if dtype.kind == 'U' else np.nan, dtype=dtype)
+                else:
+                    values = self.readChunk(c).astype(dtype)
+                npy_file.write(values.tostring())
+
+    def close(self):
+        files = []
+        for i, c in enumerate(self.columns):
+            files.append({"name": c, "file": "column_%04d.npy" % i})
+            self.writeColumn(files[-1]["file"], self.chunks[c])
+        self.writeColumn("window.npy", self.window_ids, np.dtype(np.int32))
+        np.save(os.path.join(self.directory, WINDOWS_FILE), np.array(self.windows, dtype=np.int64).reshape(-1, 2))
+        with open(os.path.join(self.directory, COLUMNS_FILE), 'w') as json_file:
+            json.dump({"columns": files, "rows": self.row_count}, json_file, indent=4)
+        self.spill.close()
+        os.remove(self.spill.name)
+        self.chunks = {}
+        self.window_ids = []
+
+
+def toArray(values):
+    """Converts the values of a column in a window into an array: int64 if they are all
+    integers, float64 if they are numbers (None, the missing values, as NaN) and strings
+    otherwise. Returns the number of values if they are all missing (see ColumnarWindowWriter)."""
+    present = [v for v in values if v is not None]
+    if not len(present):
+        return len(values)
+    if all(isinstance(v, numbers.Number) for v in present):
+        if len(present) == len(values) and all(isinstance(v, numbers.Integral) for v in present):
+            return np.array(values, dtype=np.int64)
+        return np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+    return np.array([toUnicode(v) for v in values])
+
+
+def toUnicode(value):
+    """The text of a value of a string column. The byte strings (e.g. the string fields of the
+    msgs) are decoded as UTF-8, so they can be mixed with the unicode ones."""
+    if value is None:
+        return u''
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return value if isinstance(value, unicode) else unicode(value)
+
+
+def loadColumns(directory, mmap=True):
+    """Loads a directory written by ColumnarWindowWriter. Returns a dictionary with the
+    arrays of the columns (including "window") and the window offset table, an array
+    with the [start, end) rows of each window. With mmap, the arrays are memory mapped."""
+    mode = 'r' if mmap else None
+    with open(os.path.join(directory, COLUMNS_FILE)) as json_file:
+        files = json.load(json_file)["columns"]
+    columns = dict((f["name"], np.load(os.path.join(directory, f["file"]), mmap_mode=mode)) for f in files)
+    columns["window"] = np.load(os.path.join(directory, "window.npy"), mmap_mode=mode)
+    return columns, np.load(os.path.join(directory, WINDOWS_FILE), mmap_mode=mode)
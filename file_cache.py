@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+# Persistent cache of generated files (e.g. the frequencies of the bag topics),
+# shared across sessions. Each file is stored under a key built
+# from whatever it depends on (typically the bag fingerprint plus the settings
+# used for generating it). The total size of the cache directory is bounded by
+# evicting the least recently used files.
+#
+# The cache directory and its maximum size can be changed with the
+# ROSBAG_ANNOTATOR_CACHE and ROSBAG_ANNOTATOR_CACHE_MB environment variables.
+
+import os
+import json
+import errno
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = os.environ.get("ROSBAG_ANNOTATOR_CACHE",
+                                   os.path.join(os.path.expanduser("~"), ".cache", "rosbag_annotator"))
+DEFAULT_MAX_BYTES = int(os.environ.get("ROSBAG_ANNOTATOR_CACHE_MB", 20 * 1024)) * 1024 * 1024
+PARTIAL_SUFFIX = ".part"        # marks the files still being generated.
+
+
+def bagFingerprint(filename, sample_size=1 << 20):
+    """Returns a hash identifying the content of a bag file without reading all of it:
+    its size, modification time and its first and last sample_size bytes (the bag
+    header and the index, which is at the end of the file)."""
+    digest = hashlib.sha1()
+    stat = os.stat(filename)
+    digest.update(str(stat.st_size) + ":" + repr(stat.st_mtime))
+    with open(filename, 'rb') as f:
+        digest.update(f.read(sample_size))
+        f.seek(max(stat.st_size - sample_size, 0))
+        digest.update(f.read(sample_size))
+    return digest.hexdigest()
+
+
+class FileCache(object):
+    """A directory of cached files, bounded to max_bytes (least recently used eviction)."""
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        try:
+            os.makedirs(self.directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def key(self, *parts):
+        """Builds a key from the given (json serializable) parts."""
+        return hashlib.sha1(json.dumps(parts, sort_keys=True)).hexdigest()
+
+    def path(self, key, suffix):
+        """Returns the path of the cached file of a key."""
+        return os.path.join(self.directory, key + suffix)
+
+    def partialPath(self, key, suffix):
+        """Returns the path where the file of a key must be generated before being stored.
+        The suffix is kept at the end, since some writers choose the format by it."""
+        return os.path.join(self.directory, key + PARTIAL_SUFFIX + suffix)
+
+    def lookup(self, key, suffix, description=''):
+        """Returns the path of the cached file of a key, or None if it is not cached."""
+        path = self.path(key, suffix)
+        if os.path.exists(path):
+            os.utime(path, None)        # the modification time tracks the last use.
+            logger.info("Cache HIT: " + description + " (" + path + ")")
+            return path
+        logger.info("Cache MISS: " + description)
+        return None
+
+    def store(self, partial_path, key, suffix):
+        """Moves a generated file (see partialPath) into the cache. Returns its cached path."""
+        path = self.path(key, suffix)
+        os.rename(partial_path, path)
+        self.evict(keep=path)
+        return path
+
+    def discard(self, partial_path):
+        """Removes a file that could not be completely generated."""
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+
+    def evict(self, keep=None):
+        """Removes the least recently used files until the cache fits in max_bytes."""
+        files = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if PARTIAL_SUFFIX in name or not os.path.isfile(path):
+                continue
+            stat = os.stat(path)
+            files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            if path != keep:
+                os.remove(path)
+                total -= size
+                logger.info("Cache EVICTED: " + path)
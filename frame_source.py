@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+# On demand access to the frames of a bag image topic. Instead of decoding the
+# whole topic up front, only the position of each msg in the bags (and its time)
+# is read from the bag indexes. The frames are then read and decoded when they are
+# requested, together with a few of the following ones (read-ahead), and the
+# decoded frames are kept in a bounded LRU cache.
+#
+# The decoding runs in a pool of threads (cv2 releases the GIL while decoding),
+# whose size can be changed with the ROSBAG_ANNOTATOR_DECODE_THREADS environment
+# variable (default: number of cpus).
+#
+# The frames are decoded as a proxy, downscaled to ROSBAG_ANNOTATOR_PROXY_HEIGHT
+# rows (default: 480, 0 for the full resolution), which reduces the decoding,
+# memory and painting costs in proportion to the pixels. The jpeg frames are
+# reduced while they are decoded (cv2.IMREAD_REDUCED_COLOR_*). The full
+# resolution frames are only decoded on request (see FrameSource.fullFrame).
+# Likewise, ROSBAG_ANNOTATOR_MAX_FPS (default: 30, 0 for no limit) caps the
+# frames played (see cappedFrames), so the frames skipped are not decoded.
+#
+# Given a cache (see file_cache.py), the proxy frames played are kept in a
+# memory-mapped store (see frame_store.py) instead of the memory, so they are
+# decoded once and reused by the next sessions of the bag.
+
+import os
+import cv2
+import logging
+import threading
+import multiprocessing
+import numpy as np
+from collections import OrderedDict, deque
+from multiprocessing.pool import ThreadPool
+from cv_bridge import CvBridge, CvBridgeError
+from file_cache import bagFingerprint
+from frame_store import openFrameStore
+import instrumentation
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DECODE_THREADS = int(os.environ.get("ROSBAG_ANNOTATOR_DECODE_THREADS", multiprocessing.cpu_count()))
+DEFAULT_PROXY_HEIGHT = int(os.environ.get("ROSBAG_ANNOTATOR_PROXY_HEIGHT", 480))
+DEFAULT_MAX_FPS = float(os.environ.get("ROSBAG_ANNOTATOR_MAX_FPS", 30))
+# the jpeg decoding reductions, by their factor.
+REDUCED_MODES = {2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+
+_decode_pools = {}      # number of threads -> ThreadPool. See decodePool.
+_decode_pools_lock = threading.Lock()
+
+
+def decodePool(threads):
+    """Returns the (shared, lazily created) pool of decoding threads of the given size."""
+    with _decode_pools_lock:
+        if threads not in _decode_pools:
+            _decode_pools[threads] = ThreadPool(threads)
+        return _decode_pools[threads]
+
+
+def parallelDecode(decode, msgs, threads=DEFAULT_DECODE_THREADS, in_flight=None):
+    """Generator of decode(msg) for each msg of the msgs iterable, in the same order.
+    The msgs are decoded by a pool of threads, with at most in_flight of them (default:
+    twice the threads) submitted and not yielded yet, which bounds the memory used when
+    the consumer is slower than the decoding. The msgs iterable is consumed from the
+    calling thread, so it can read from a bag (which is not thread safe)."""
+    if threads <= 1:
+        for msg in msgs:
+            yield decode(msg)
+        return
+    pool = decodePool(threads)
+    in_flight = in_flight or 2 * threads
+    pending = deque()
+    for msg in msgs:
+        if len(pending) >= in_flight:
+            yield pending.popleft().get()
+        pending.append(pool.apply_async(decode, (msg,)))
+    while len(pending):
+        yield pending.popleft().get()
+
+
+def decodeImage(msg, compressed=True, bridge=None, max_height=0, reduction=1):
+    """Decodes an image msg (sensor_msgs/CompressedImage or sensor_msgs/Image) into a BGR frame.
+    A compressed image is decoded reduced by the given factor (1, 2, 4 or 8), and the frame is
+    then downscaled (keeping its aspect ratio) if it has more than max_height rows (0: no limit)."""
+    if not compressed:
+        try:
+            frame = (bridge or CvBridge()).imgmsg_to_cv2(msg, "bgr8")
+        except CvBridgeError as e:
+            logger.error(str(e))
+            return None
+    else:
+        frame = cv2.imdecode(np.frombuffer(msg.data, np.uint8), REDUCED_MODES.get(reduction, cv2.IMREAD_COLOR))
+    if frame is not None and 0 < max_height < frame.shape[0]:
+        width = max(1, int(round(frame.shape[1] * max_height / float(frame.shape[0]))))
+        frame = cv2.resize(frame, (width, max_height), interpolation=cv2.INTER_AREA)
+    return frame
+
+
+def decodeReduction(height, max_height):
+    """Returns the largest jpeg decoding reduction (see decodeImage) of a frame with the given
+    height that keeps at least max_height rows."""
+    reduction = 1
+    while max_height > 0 and reduction < 8 and height // (reduction * 2) >= max_height:
+        reduction *= 2
+    return reduction
+
+
+def cappedFrames(times_secs, max_fps=DEFAULT_MAX_FPS):
+    """Returns the indexes of the frames played at most at max_fps (0: all of them): the first
+    frame of each 1 / max_fps period, counted from the first frame."""
+    if max_fps <= 0 or not len(times_secs):
+        return np.arange(len(times_secs))
+    return np.unique(np.floor((times_secs - times_secs[0]) * max_fps), return_index=True)[1]
+
+
+class FrameSource(object):
+    """Gives the decoded (BGR, unless converted) frames of an image topic by their index.
+        bag         :   the BagSession object (see bag_session.py).
+        topic       :   the image topic name.
+        compressed  :   whether the topic type is sensor_msgs/CompressedImage (or sensor_msgs/Image).
+        cache_size  :   maximum number of decoded frames kept in memory.
+        read_ahead  :   number of frames decoded at once when a frame is not in the cache.
+        threads     :   number of threads decoding the frames (see parallelDecode).
+        proxy_height:   maximum number of rows of the frames (0: full resolution). See fullFrame.
+        max_fps     :   frame rate cap of the frames played (see cappedFrames), which are the
+                        ones decoded by the read-ahead.
+        conversion  :   cv2 color conversion code applied to the frames as they are decoded
+                        (e.g. cv2.COLOR_BGR2BGRA for painting them with no conversion), or None.
+        store_cache :   FileCache where the proxy frames played are stored (see frame_store.py),
+                        or None for keeping the frames only in memory.
+    """
+
+    def __init__(self, bag, topic, compressed=True, cache_size=64, read_ahead=16, threads=DEFAULT_DECODE_THREADS,
+                 proxy_height=DEFAULT_PROXY_HEIGHT, max_fps=DEFAULT_MAX_FPS, conversion=None, store_cache=None):
+        self.bag = bag
+        self.topic = topic
+        self.compressed = compressed
+        self.cache_size = max(cache_size, read_ahead)
+        self.read_ahead = read_ahead
+        self.threads = threads
+        self.proxy_height = proxy_height
+        self.conversion = conversion
+        self.reduction = 1              # jpeg decoding reduction of the proxy frames, see decodeReduction.
+        self.full_frame = (-1, None)    # the last full resolution frame decoded and its index.
+        self.cache = OrderedDict()      # frame index -> decoded frame, in least recently used order.
+        self.store = None               # the FrameStore of the frames played, see openStore.
+        self.bridge = CvBridge()
+
+        self.stamps, self.positions = bag.topicIndex(topic)
+        # time of each frame (in secs) relative to the first frame of the topic.
+        self.times_secs = (self.stamps - self.stamps[0]) / 1e9 if len(self.stamps) else np.zeros(0)
+        self.played = cappedFrames(self.times_secs, max_fps)
+        if len(self.stamps) and proxy_height > 0:
+            # the reduction is given by the size of the first frame.
+            self.full_frame = (0, self.decode(self.readMessage(0), full=True))
+            if self.full_frame[1] is not None:
+                self.reduction = decodeReduction(self.full_frame[1].shape[0], proxy_height)
+            if store_cache is not None:
+                self.openStore(store_cache, max_fps)
+        logger.info("Image topic " + topic + " indexed: " + str(len(self)) + " frames")
+
+    def openStore(self, cache, max_fps):
+        """Opens the store of the proxy frames played (see frame_store.py). Their shape is
+        given by the first frame."""
+        first = self.decode(self.readMessage(0))
+        if first is None:
+            return
+        key = cache.key("frames", [bagFingerprint(f) for f in self.bag.filenames], self.topic,
+                        self.proxy_height, max_fps, self.conversion, list(first.shape))
+        self.store = openFrameStore(cache, key, self.played, self.stamps[self.played], first.shape, self.topic)
+        if self.store is not None:
+            self.store.put(0, first)
+
+    def close(self):
+        """Closes the frame store. The frames it gave must not be used anymore."""
+        if self.store is not None:
+            self.store.close()
+            self.store = None
+
+    def __len__(self):
+        return len(self.positions)
+
+    def frameIndex(self, secs):
+        """Returns the index of the frame shown at the given time (in secs, relative to
+        the first frame), that is, the last frame arriving at or before it."""
+        return int(np.clip(self.times_secs.searchsorted(secs, side='right') - 1, 0, len(self) - 1))
+
+    def frame(self, i):
+        """Returns the i-th decoded frame, from the frame store or the memory cache. On a
+        miss, the following frames are decoded too (see prefetch)."""
+        frame = self.storedFrame(i)
+        if frame is not None:
+            return frame
+        if i not in self.cache:
+            self.prefetch(i, self.read_ahead)
+            frame = self.storedFrame(i)
+            if frame is not None:
+                return frame
+        # marks the frame as the most recently used one.
+        frame = self.cache.pop(i)
+        self.cache[i] = frame
+        return frame
+
+    def frames(self, start=0, stop=None):
+        """Generator of the decoded frames in the [start, stop) index range. Meant for
+        sequential reads of the whole topic (e.g. writing a video): the frames are decoded
+        as a continuous stream (see parallelDecode) and are not kept in the cache."""
+        indexes = range(start, len(self) if stop is None else min(stop, len(self)))
+        msgs = (self.readMessage(i) for i in indexes)
+        return parallelDecode(self.decode, msgs, self.threads)
+
+    def fullFrame(self, i):
+        """Returns the i-th frame at its full resolution. The last one decoded is kept."""
+        if self.proxy_height <= 0:
+            return self.frame(i)
+        if self.full_frame[0] != i:
+            self.full_frame = (i, self.decode(self.readMessage(i), full=True))
+        return self.full_frame[1]
+
+    def prefetch(self, start, count):
+        """Decodes the start frame and the count - 1 played frames following it (see
+        cappedFrames) that are not in the store nor in the cache yet, evicting the least
+        recently used frames when the cache is full."""
+        following = self.played[self.played.searchsorted(start, side='right'):][:max(count - 1, 0)]
+        indexes = ([start] if 0 <= start < len(self) else []) + following.tolist()
+        missing = [i for i in indexes if i not in self.cache and self.storedFrame(i) is None]
+        msgs = (self.readMessage(i) for i in missing)
+        for i, frame in zip(missing, parallelDecode(self.decode, msgs, self.threads)):
+            # the frames that are not stored (see frame_store.py) are kept in memory.
+            if self.store is None or not self.store.put(i, frame):
+                self.cache[i] = frame
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def storedFrame(self, i):
+        """Returns the i-th frame from the frame store, or None if it is not stored."""
+        return self.store.get(i) if self.store is not None else None
+
+    def readMessage(self, i):
+        """Reads the i-th msg of the topic from the bags."""
+        return self.bag.readMessage(self.positions[i])
+
+    def decode(self, msg, full=False):
+        """Decodes an image msg into a proxy frame (or a full resolution one), converting its colors."""
+        with instrumentation.span("decode full" if full else "decode", items=1, bytes=len(msg.data)):
+            if full:
+                frame = decodeImage(msg, self.compressed, self.bridge)
+            else:
+                frame = decodeImage(msg, self.compressed, self.bridge, self.proxy_height, self.reduction)
+            if frame is not None and self.conversion is not None:
+                frame = cv2.cvtColor(frame, self.conversion)
+            return frame
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+# On disk store of the decoded frames of an image topic, memory-mapped. The
+# frames are kept in a single file with a fixed-size slot per frame, so a frame
+# is a view of the mapped file and the OS page cache decides which frames stay in
+# RAM: the frames stored can be more than the memory, and the heap only holds the
+# few frames decoded but not stored (see FrameSource). The file is kept in the
+# cache (see file_cache.py), so reopening a bag maps the frames decoded in the
+# previous sessions instead of decoding them again.
+#
+# Layout of the file (all the arrays are in the native byte order):
+#
+#   header  :   json with the version, the number of frames and the frame shape,
+#               padded to HEADER_SIZE bytes.
+#   indexes :   int64 array, the index of the frame (in the topic) of each slot.
+#   stamps  :   int64 array, the time (in nsecs) of the frame of each slot.
+#   filled  :   uint8 array, whether each slot holds its decoded frame.
+#   frames  :   uint8 array of (frames, height, width, channels), starting at a
+#               multiple of PAGE_SIZE bytes.
+
+import os
+import json
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+VERSION = 1
+HEADER_SIZE = 4096
+PAGE_SIZE = 4096
+
+
+def storeLayout(count, shape):
+    """Returns the offsets of the arrays of a store (indexes, stamps, filled, frames) and its size in bytes."""
+    indexes = HEADER_SIZE
+    stamps = indexes + 8 * count
+    filled = stamps + 8 * count
+    frames = (filled + count + PAGE_SIZE - 1) // PAGE_SIZE * PAGE_SIZE
+    return (indexes, stamps, filled, frames), frames + count * int(np.prod(shape))
+
+
+class FrameStore(object):
+    """The memory-mapped store of the frames of the given indexes (sorted) of an image topic.
+        path    :   the store file. If it exists and holds the same frames (indexes, times and
+                    shape), its frames are kept. Otherwise it is created, with no frame filled.
+        indexes :   the indexes (in the topic) of the frames stored, e.g. those played.
+        stamps  :   the time (in nsecs) of each of these frames.
+        shape   :   the (height, width, channels) of the frames. Frames of other shapes are not stored.
+    """
+
+    def __init__(self, path, indexes, stamps, shape):
+        self.path = path
+        self.shape = tuple(shape)
+        self.indexes = np.asarray(indexes, dtype=np.int64)
+        count = len(self.indexes)
+        (indexes_offset, stamps_offset, filled_offset, frames_offset), size = storeLayout(count, self.shape)
+        header = {"version": VERSION, "frames": count, "shape": list(self.shape)}
+
+        if not self.isValid(header, stamps, indexes_offset, stamps_offset):
+            logger.debug("Creating the frame store " + path)
+            with open(path, 'wb') as store_file:
+                store_file.write(json.dumps(header).ljust(HEADER_SIZE))
+                store_file.write(self.indexes.tostring())
+                store_file.write(np.asarray(stamps, dtype=np.int64).tostring())
+                # the slots are not written, so the file is sparse until they are filled.
+                store_file.truncate(size)
+        self.filled = np.memmap(path, np.uint8, 'r+', filled_offset, (count,))
+        self.frames = np.memmap(path, np.uint8, 'r+', frames_offset, (count,) + self.shape)
+
+    def isValid(self, header, stamps, indexes_offset, stamps_offset):
+        """Whether the store file exists and holds the frames of the given header and times."""
+        if not os.path.exists(self.path):
+            return False
+        try:
+            with open(self.path, 'rb') as store_file:
+                if json.loads(store_file.read(HEADER_SIZE)) != header:
+                    return False
+            count = len(self.indexes)
+            return (np.array_equal(np.memmap(self.path, np.int64, 'r', indexes_offset, (count,)), self.indexes) and
+                    np.array_equal(np.memmap(self.path, np.int64, 'r', stamps_offset, (count,)), stamps))
+        except ValueError:
+            return False
+
+    def __len__(self):
+        return int(np.count_nonzero(self.filled))
+
+    def slot(self, i):
+        """Returns the slot of the i-th frame of the topic, or -1 if it is not stored."""
+        slot = int(self.indexes.searchsorted(i))
+        return slot if slot < len(self.indexes) and self.indexes[slot] == i else -1
+
+    def get(self, i):
+        """Returns the i-th frame of the topic (a view of the mapped file), or None if it is not filled."""
+        slot = self.slot(i)
+        if slot < 0 or not self.filled[slot]:
+            return None
+        return self.frames[slot]
+
+    def put(self, i, frame):
+        """Stores the i-th frame of the topic. Returns whether it was stored (frames of another
+        shape and frames out of the store are not). A filled slot is not written again, since
+        the frames returned by get may still be in use."""
+        slot = self.slot(i)
+        if slot < 0 or frame is None or frame.shape != self.shape:
+            return False
+        if not self.filled[slot]:
+            self.frames[slot] = frame
+            self.filled[slot] = 1
+        return True
+
+    def flush(self):
+        self.frames.flush()
+        self.filled.flush()
+
+    def close(self):
+        """Writes the frames filled to the file and unmaps it."""
+        self.flush()
+        self.frames = self.filled = None
+
+
+def openFrameStore(cache, key, indexes, stamps, shape, description=''):
+    """Returns the FrameStore of the given key in the cache (see FrameStore for the arguments),
+    or None if it would not fit in the cache (the frames are then only kept in memory)."""
+    size = storeLayout(len(indexes), shape)[1]
+    if size > cache.max_bytes:
+        logger.info("The frames of " + description + " (" + str(size // (1024 * 1024)) + " MB) do not fit in the cache,"
+                    " they are not stored. See ROSBAG_ANNOTATOR_CACHE_MB.")
+        return None
+    path = cache.lookup(key, ".frames", "frames of " + description) or cache.path(key, ".frames")
+    try:
+        store = FrameStore(path, indexes, stamps, shape)
+    except (IOError, OSError) as e:
+        logger.warning("Could not open the frame store " + path + ": " + str(e))
+        return None
+    # makes room for the store, evicting older files.
+    cache.evict(keep=path)
+    logger.info("Frame store of " + description + ": " + str(len(store)) + " of " + str(len(indexes)) +
+                " frames decoded in previous sessions")
+    return store
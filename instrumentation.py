@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+# Lightweight instrumentation of the stages of the bag loading and of the data
+# export: named spans (timed stages) and counters, with the number of items
+# (msgs, frames, rows) and bytes they handle. For instance:
+#
+#   with instrumentation.span("decode", bytes=len(msg.data)):
+#       frame = cv2.imdecode(...)
+#
+#   for topic, msg, t in instrumentation.timed("bag read", bag.read_messages()):
+#       ...     # the time spent reading (and deserializing) each msg is measured
+#
+# It is off unless the ROSBAG_ANNOTATOR_INSTRUMENT environment variable is set
+# (e.g. to 1), and then spans and counters cost a global check each. When it is
+# on, the summary of the stages (see summary) is shown in the log areas, and a
+# Chrome trace (chrome://tracing) and a pstats file (python -m pstats) of the
+# spans can be written (see dump).
+
+import os
+import json
+import time
+import marshal
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.environ.get("ROSBAG_ANNOTATOR_INSTRUMENT", "") not in ("", "0")
+MAX_EVENTS = 200000     # spans kept for the Chrome trace (the oldest ones are dropped).
+
+_lock = threading.Lock()
+_stages = {}                        # name -> [calls, secs, items, bytes]
+_events = deque(maxlen=MAX_EVENTS)  # (name, start time, secs, thread id) of the spans.
+_origin = time.time()
+_reported = []                      # the last summary logged. See report.
+
+
+def enable(enabled=True):
+    global ENABLED
+    ENABLED = enabled
+
+
+def record(name, start, secs, items=0, bytes=0, event=True):
+    """Adds a call of a stage, which took secs (from start) and handled items and bytes."""
+    with _lock:
+        stage = _stages.get(name)
+        if stage is None:
+            stage = _stages[name] = [0, 0.0, 0, 0]
+        stage[0] += 1
+        stage[1] += secs
+        stage[2] += items
+        stage[3] += bytes
+        if event:
+            _events.append((name, start, secs, threading.current_thread().ident))
+
+
+class Span(object):
+    """Times a stage (see span). Its items and bytes can be added while it runs."""
+    __slots__ = ("name", "items", "bytes", "start")
+
+    def __init__(self, name, items=0, bytes=0):
+        self.name = name
+        self.items = items
+        self.bytes = bytes
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        record(self.name, self.start, time.time() - self.start, self.items, self.bytes)
+        return False
+
+    def add(self, items=0, bytes=0):
+        self.items += items
+        self.bytes += bytes
+
+
+class NullSpan(object):
+    """The span given when the instrumentation is off, which does nothing."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def add(self, items=0, bytes=0):
+        pass
+
+NULL_SPAN = NullSpan()
+
+
+def span(name, items=0, bytes=0):
+    """Returns a context manager timing the stage name."""
+    if not ENABLED:
+        return NULL_SPAN
+    return Span(name, items, bytes)
+
+
+def count(name, items=1, bytes=0):
+    """Adds items and bytes to the stage name, with no time."""
+    if ENABLED:
+        record(name, None, 0.0, items, bytes, event=False)
+
+
+def timed(name, iterable):
+    """Returns the iterable, measuring the time spent producing each of its items (e.g. the
+    msgs read from a bag) as the stage name."""
+    if not ENABLED:
+        return iterable
+    return timedIterator(name, iterable)
+
+
+def timedIterator(name, iterable):
+    iterator = iter(iterable)
+    while True:
+        start = time.time()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        # the items are not kept as trace events, there are too many of them.
+        record(name, start, time.time() - start, 1, 0, event=False)
+        yield item
+
+
+def reset():
+    with _lock:
+        _stages.clear()
+        _events.clear()
+
+
+def summary():
+    """Returns the lines of the summary of the stages, the slowest first: calls, time,
+    items (and items/s) and MB."""
+    with _lock:
+        stages = sorted(_stages.items(), key=lambda s: -s[1][1])
+    lines = []
+    for name, (calls, secs, items, bytes) in stages:
+        rate = ("%10.0f items/s" % (items / secs)) if secs > 0 and items else " " * 18
+        lines.append("%-20s %8d calls %9.3fs %10d items %s %9.1f MB" % (name, calls, secs, items, rate, bytes / 1e6))
+    return lines
+
+
+def report(title, changes_only=False):
+    """Logs the summary of the stages (if the instrumentation is on). With changes_only, it is
+    only logged if it changed since the last one logged (for logging it periodically)."""
+    global _reported
+    if not ENABLED:
+        return
+    lines = summary()
+    if len(lines) and not (changes_only and lines == _reported):
+        logger.info("TIMINGS (" + title + "):\n\t" + "\n\t".join(lines))
+    _reported = lines
+
+
+def dumpChromeTrace(filename):
+    """Writes the spans as a Chrome trace (chrome://tracing or https://ui.perfetto.dev)."""
+    with _lock:
+        events = list(_events)
+    pid = os.getpid()
+    trace = [{"name": name, "cat": "stage", "ph": "X", "pid": pid, "tid": tid,
+              "ts": (start - _origin) * 1e6, "dur": secs * 1e6} for name, start, secs, tid in events]
+    with open(filename, 'w') as json_file:
+        json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, json_file)
+
+
+def dumpProfile(filename):
+    """Writes the stages as a pstats file (python -m pstats filename), each stage being a function."""
+    with _lock:
+        stats = dict((("instrumentation", 0, name), (calls, calls, secs, secs, {}))
+                     for name, (calls, secs, items, bytes) in _stages.items())
+    with open(filename, 'wb') as profile_file:
+        marshal.dump(stats, profile_file)
+
+
+def dump(directory, name):
+    """Writes the Chrome trace (name.trace.json) and the pstats file (name.prof) into directory
+    (if the instrumentation is on). Returns the file names."""
+    if not ENABLED:
+        return []
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    filenames = [os.path.join(directory, name + ".trace.json"), os.path.join(directory, name + ".prof")]
+    dumpChromeTrace(filenames[0])
+    dumpProfile(filenames[1])
+    logger.info("Timings written to " + " and ".join(filenames))
+    return filenames
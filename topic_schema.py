@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+# Trees of the fields of the msg types, as shown in the tree of topics of the
+# annotator and saved in the "topics" of the annotation json. For instance, the
+# tree of a sensor_msgs/Imu msg is:
+#
+#   {"orientation": {"x": [], "y": [], "z": [], "w": []}, "orientation_covariance": [],
+#    "angular_velocity": {"x": [], "y": [], "z": []}, ...}
+#
+# where the leaves (primitive fields and arrays) are empty lists and the header
+# fields are left out. The tree is derived from the msg definition stored in the
+# bag connection (the full text of the type and of the types it uses), so no msg
+# class has to be generated nor msg read. The trees are kept by the type md5,
+# in memory and in the cache (see file_cache.py), so each type is parsed once.
+
+import json
+import logging
+import instrumentation
+
+logger = logging.getLogger(__name__)
+
+PRIMITIVE_TYPES = set(["bool", "byte", "char", "int8", "uint8", "int16", "uint16", "int32", "uint32",
+                       "int64", "uint64", "float32", "float64", "string"])
+TIME_TYPES = set(["time", "duration"])      # their fields are secs and nsecs.
+DEFINITION_SEPARATOR = "=" * 80             # separates the types of a msg definition.
+
+
+def parseDefinition(datatype, msg_def):
+    """Parses a msg definition (as stored in the bag connections). Returns a dictionary
+    with the (field type, field name) list of the type and of each type it uses."""
+    types = {}
+    current = datatype
+    fields = types[current] = []
+    for line in msg_def.splitlines():
+        if line.startswith(DEFINITION_SEPARATOR):
+            continue
+        if line.startswith("MSG:"):
+            current = line[4:].strip()
+            fields = types[current] = []
+            continue
+        line = line.split("#")[0].strip()
+        # the constants are not fields.
+        if not line or "=" in line:
+            continue
+        field_type, name = line.split()[:2]
+        fields.append((field_type, name))
+    return types
+
+
+def resolveType(field_type, package, types):
+    """Returns the full name (package/Type) of a field type, as the msg generator does:
+    Header is std_msgs/Header and the types with no package are in the package of the msg."""
+    if "/" in field_type:
+        return field_type
+    if field_type == "Header":
+        return "std_msgs/Header"
+    if package + "/" + field_type in types:
+        return package + "/" + field_type
+    for t in types.keys():
+        if t.split("/")[-1] == field_type:
+            return t
+    return package + "/" + field_type
+
+
+def definitionTree(datatype, types):
+    """Returns the tree of the fields of a type parsed by parseDefinition."""
+    if datatype not in types:
+        raise KeyError("no definition of " + datatype)
+    tree = {}
+    package = datatype.split("/")[0]
+    for field_type, name in types[datatype]:
+        if name.startswith("header"):
+            continue
+        if "[" in field_type or field_type in PRIMITIVE_TYPES:
+            tree[name] = []
+        elif field_type in TIME_TYPES:
+            tree[name] = {"secs": [], "nsecs": []}
+        else:
+            tree[name] = definitionTree(resolveType(field_type, package, types), types)
+    return tree
+
+
+def messageTree(msg):
+    """Returns the tree of the fields of a msg instance: its __slots__, recursively.
+    Used for the types whose definition cannot be parsed."""
+    tree = {}
+    for s in msg.__slots__:
+        if s.startswith("header"):
+            continue
+        value = getattr(msg, s)
+        tree[s] = messageTree(value) if hasattr(value, '__slots__') else []
+    return tree
+
+
+def treeLeaves(tree, value):
+    """Returns a copy of a tree with the given value in its leaves."""
+    return dict((k, treeLeaves(v, value) if isinstance(v, dict) else value) for k, v in tree.items())
+
+
+class SchemaRegistry(object):
+    """Gives the tree of the fields of the msg type of the bag connections.
+        cache   :   FileCache keeping the trees across sessions (None for not keeping them).
+    """
+
+    def __init__(self, cache=None):
+        self.cache = cache
+        self.trees = {}         # md5 -> tree of the type.
+
+    def tree(self, bag, conn):
+        """Returns the tree of the msg type of a connection of the bag (a BagSession, see
+        bag_session.py). The msgs of the connection are only read if its definition cannot
+        be parsed, in that case the first one is used."""
+        if conn.md5sum in self.trees:
+            return self.trees[conn.md5sum]
+        tree = self.load(conn.md5sum)
+        if tree is None:
+            try:
+                tree = definitionTree(conn.datatype, parseDefinition(conn.datatype, conn.msg_def))
+            except Exception as e:
+                logger.warning("Could not parse the definition of " + conn.datatype + ": " + str(e))
+                index = bag.connection_indexes[conn.id]
+                tree = messageTree(bag.readMessage((conn.id, int(index.chunk_pos[0]), int(index.offsets[0]))))
+            self.store(conn.md5sum, tree)
+        self.trees[conn.md5sum] = tree
+        return tree
+
+    def topicTrees(self, bag, topics):
+        """Returns a dictionary with the tree of each of the given topics of the bag."""
+        trees = {}
+        with instrumentation.span("topic trees", items=len(topics)):
+            for conn in bag._get_connections(topics=topics):
+                if conn.topic not in trees:
+                    trees[conn.topic] = self.tree(bag, conn)
+        return trees
+
+    def load(self, md5sum):
+        """Returns the tree of a type kept in the cache, or None."""
+        if self.cache is None:
+            return None
+        path = self.cache.lookup(self.cache.key("schema", md5sum), ".json")
+        if path is None:
+            return None
+        try:
+            with open(path) as json_file:
+                return json.load(json_file)
+        except ValueError:
+            return None
+
+    def store(self, md5sum, tree):
+        """Writes the tree of a type into the cache."""
+        if self.cache is None:
+            return
+        key = self.cache.key("schema", md5sum)
+        partial_file = self.cache.partialPath(key, ".json")
+        with open(partial_file, 'w') as json_file:
+            json.dump(tree, json_file)
+        self.cache.store(partial_file, key, ".json")